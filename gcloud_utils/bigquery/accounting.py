@@ -0,0 +1,41 @@
+"""Module to account for the resources used by BigQuery jobs in this process"""
+import numbers
+import threading
+
+
+class JobAccounting(object):
+    """Thread-safe totals of jobs, bytes processed, bytes billed and slot
+    milliseconds of the jobs recorded"""
+
+    FIELDS = ("total_bytes_processed", "total_bytes_billed", "slot_millis")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero every counter"""
+        with self._lock:
+            self.jobs = 0
+            self.total_bytes_processed = 0
+            self.total_bytes_billed = 0
+            self.slot_millis = 0
+
+    def record(self, job):
+        """Add the statistics of a finished job, missing ones count as zero"""
+        with self._lock:
+            self.jobs += 1
+            for field in self.FIELDS:
+                value = getattr(job, field, None)
+                if isinstance(value, numbers.Integral):
+                    setattr(self, field, getattr(self, field) + value)
+
+    def snapshot(self):
+        """Return the counters as a dict"""
+        with self._lock:
+            result = dict((field, getattr(self, field)) for field in self.FIELDS)
+            result["jobs"] = self.jobs
+            return result
+
+
+ACCOUNTING = JobAccounting()
@@ -1,12 +1,34 @@
 """Module to handle Google BigQuery Service"""
 
 import logging
+from datetime import datetime, timedelta
 
 from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
+from google.cloud.bigquery._helpers import _row_tuple_from_json
 
 from gcloud_utils.base_client import BaseClient
+from gcloud_utils.bigquery import columnar
+from gcloud_utils.bigquery.accounting import ACCOUNTING
+from gcloud_utils.bigquery.jobs import FailedSubmission, as_completed, wait_all
 from gcloud_utils.bigquery.query_builder import QueryBuilder
+from gcloud_utils.bigquery.row_writer import RowWriter
+
+
+DEFAULT_DATE_FORMAT = '%Y%m%d'
+MAX_LOAD_URIS = 10000
+
+
+def date_vars(day, date_format=DEFAULT_DATE_FORMAT):
+    """Query vars of a day, as filled by the query_to_table CLI"""
+    one_day = timedelta(1)
+    previous_date = (day - one_day).strftime(date_format)
+    return {
+        "previous_date": previous_date,
+        "previews_date": previous_date,
+        "start_date": day.strftime(date_format),
+        "next_date": (day + one_day).strftime(date_format),
+    }
 
 
 class Bigquery(BaseClient):
@@ -26,33 +48,288 @@ class Bigquery(BaseClient):
         "snappy": "SNAPPY"
     }
 
+    ROW_FORMATS = ("tuple", "dict", "row")
+
     _MODEL_CLIENT = bigquery
 
-    def __init__(self, client=None, log_level=logging.ERROR):
+    def __init__(self, client=None, log_level=logging.ERROR, query_cache=None,
+                 max_bytes_billed=None, metadata_cache=None):
+        """`query_cache` is an optional result_cache.QueryCache used by query.
+        `max_bytes_billed` caps the limit of every query job, lowering a
+        higher limit of its job_config, so BigQuery fails queries that would
+        bill more than that.
+        `metadata_cache` is an optional metadata_cache.MetadataCache sparing
+        the requests of table_exists, create_dataset and create_table"""
         super(Bigquery, self).__init__(client, log_level)
         self._query = None
+        self._query_cache = query_cache
+        self.metadata_cache = metadata_cache
+        self.max_bytes_billed = max_bytes_billed
+
+    @property
+    def accounting(self):
+        """Per-process accounting.JobAccounting of the jobs waited through this
+        wrapper or through gcloud_utils.bigquery.jobs"""
+        return ACCOUNTING
 
-    def query(self, query_or_object, **kwargs):
-        """Execute a query"""
+    def _wait(self, job, **kwargs):
+        result = job.result(**kwargs)
+        ACCOUNTING.record(job)
+        return result
+
+    @staticmethod
+    def _with_parameters(query_or_object, kwargs):
+        """Set the query parameters of a rendered QueryBuilder on the job config"""
+        parameters = getattr(query_or_object, "query_parameters", None)
+        if parameters:
+            job_config = kwargs.get("job_config") or bigquery.QueryJobConfig()
+            job_config.query_parameters = parameters
+            kwargs["job_config"] = job_config
+        return kwargs
+
+    def _submit_query(self, query_or_object, **kwargs):
+        kwargs = self._with_parameters(query_or_object, kwargs)
         if isinstance(query_or_object, QueryBuilder):
+            if query_or_object.unresolved:
+                self.logger.warning("Query submitted with unresolved vars: %s",
+                                    ", ".join(query_or_object.unresolved))
             kwargs["query"] = query_or_object.query
         else:
             kwargs["query"] = query_or_object
 
+        if self.max_bytes_billed is not None:
+            job_config = kwargs.get("job_config") or bigquery.QueryJobConfig()
+            if job_config.maximum_bytes_billed is None:
+                job_config.maximum_bytes_billed = self.max_bytes_billed
+            else:
+                job_config.maximum_bytes_billed = min(
+                    int(job_config.maximum_bytes_billed), self.max_bytes_billed)
+            kwargs["job_config"] = job_config
+
         self._query = kwargs["query"]
-        return self._client.query(**kwargs).result()
+        return self._client.query(**kwargs)
+
+    def query(self, query_or_object, dry_run=False, **kwargs):
+        """Execute a query.
+        With `dry_run` nothing is executed and the estimate of `dry_run` is returned.
+        With a query cache, results of queries without a destination table are
+        served from the cache and returned as a list of rows"""
+        if dry_run:
+            return self.dry_run(query_or_object, **kwargs)
+        if self._query_cache is not None and self._query_cache.cacheable(kwargs):
+            return self._cached_query(query_or_object, **kwargs)
+        return self._wait(self.query_async(query_or_object, **kwargs))
+
+    def dry_run(self, query_or_object, job_config=None, **kwargs):
+        """Validate a query without running it and return a dict with the
+        "total_bytes_processed" it would scan, its "referenced_tables" as
+        project.dataset.table and "within_max_bytes_billed", False when the
+        estimate exceeds the limit of the job"""
+        config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr()) \
+            if job_config is not None else bigquery.QueryJobConfig()
+        config.dry_run = True
+        config.use_query_cache = False
+        job = self._submit_query(query_or_object, job_config=config, **kwargs)
+
+        limit = config.maximum_bytes_billed
+        return {
+            "total_bytes_processed": job.total_bytes_processed,
+            "referenced_tables": ["{}.{}.{}".format(
+                table.project, table.dataset_id, table.table_id)
+                                  for table in job.referenced_tables],
+            "within_max_bytes_billed": limit is None or job.total_bytes_processed <= int(limit)
+        }
+
+    def _cached_query(self, query_or_object, **kwargs):
+        query = query_or_object.query if isinstance(query_or_object, QueryBuilder) \
+            else query_or_object
+        kwargs = self._with_parameters(query_or_object, kwargs)
+        key = self._query_cache.key(query, kwargs)
+        rows = self._query_cache.get(key, self._client)
+        if rows is not None:
+            self.logger.debug("Query result served from cache")
+            self._query = query
+            return rows
+
+        job = self.query_async(query_or_object, **kwargs)
+        rows = list(self._wait(job))
+        if job.statement_type == "SELECT":
+            self._query_cache.set(key, rows, job.referenced_tables, self._client)
+        return rows
+
+    def query_async(self, query_or_object, **kwargs):
+        """Submit a query and return its QueryJob without waiting for it,
+        see gcloud_utils.bigquery.jobs to wait on many jobs"""
+        return self._submit_query(query_or_object, **kwargs)
+
+    def query_iter(self, query_or_object, page_size=None, max_rows=None,
+                   row_format="tuple", columns=None, **kwargs):
+        """Execute a query and lazily yield its rows, fetching `page_size` rows
+        per request and at most `max_rows` rows.
+        Rows are tuples, dicts or bigquery Row objects according to `row_format`;
+        tuples and dicts are decoded straight from the API response. `columns`
+        restricts the fetched columns to the given names, in that order"""
+        if row_format not in self.ROW_FORMATS:
+            raise ValueError("Only valid row formats: {}".format(",".join(self.ROW_FORMATS)))
+        return self._query_rows(query_or_object, page_size, max_rows, row_format, columns,
+                                kwargs)
+
+    def _query_rows(self, query_or_object, page_size, max_rows, row_format, columns, kwargs):
+        job = self._submit_query(query_or_object, **kwargs)
+        rows, schema = self._result_rows(job, page_size, max_rows, columns)
+        if row_format == "tuple":
+            rows.item_to_value = lambda _, resource: _row_tuple_from_json(resource, schema)
+        elif row_format == "dict":
+            names = [field.name for field in schema]
+            rows.item_to_value = lambda _, resource: dict(
+                zip(names, _row_tuple_from_json(resource, schema)))
+        for row in rows:
+            yield row
+
+    def _result_rows(self, job, page_size, max_rows, columns):
+        """Wait for a query job and return a lazy iterator over its result
+        table with the schema of the fetched columns"""
+        schema = list(self._wait(job, page_size=page_size).schema)
+        if columns is not None:
+            fields = dict((field.name, field) for field in schema)
+            schema = [fields[column] for column in columns]
+
+        rows = self._client.list_rows(job.destination, selected_fields=schema,
+                                      page_size=page_size, max_results=max_rows)
+        return rows, schema
+
+    def _batches(self, rows, schema, batch_format):
+        rows.item_to_value = lambda _, resource: resource
+        for page in rows.pages:
+            raw_rows = list(page)
+            if raw_rows:
+                yield columnar.to_format(
+                    columnar.decode_page(raw_rows, schema), schema, batch_format)
+
+    @staticmethod
+    def _check_batch_format(batch_format):
+        if batch_format not in columnar.BATCH_FORMATS:
+            raise ValueError("Only valid batch formats: {}".format(
+                ",".join(columnar.BATCH_FORMATS)))
+
+    def _query_batches(self, query_or_object, batch_format, page_size, max_rows,
+                       columns, kwargs):
+        job = self._submit_query(query_or_object, **kwargs)
+        rows, schema = self._result_rows(job, page_size, max_rows, columns)
+        return self._batches(rows, schema, batch_format), schema
+
+    def _lazy_batches(self, query_or_object, batch_format, page_size, max_rows,
+                      columns, kwargs):
+        batches, _ = self._query_batches(
+            query_or_object, batch_format, page_size, max_rows, columns, kwargs)
+        for batch in batches:
+            yield batch
+
+    def query_batches(self, query_or_object, batch_format="arrow", page_size=None,
+                      max_rows=None, columns=None, **kwargs):
+        """Execute a query and lazily yield its result one page at a time in a
+        columnar `batch_format`: "arrow" record batches (needs pyarrow),
+        "numpy" dicts of arrays or "pandas" DataFrames (needs pandas).
+        Each column of a page is decoded at once, see columnar.decode_page"""
+        self._check_batch_format(batch_format)
+        return self._lazy_batches(
+            query_or_object, batch_format, page_size, max_rows, columns, kwargs)
+
+    def query_columns(self, query_or_object, batch_format="arrow", page_size=None,
+                      max_rows=None, columns=None, **kwargs):
+        """Execute a query and return the whole result in a columnar format:
+        an Arrow Table, a dict of NumPy arrays or a pandas DataFrame.
+        Accepts the same arguments as `query_batches`"""
+        self._check_batch_format(batch_format)
+        batches, schema = self._query_batches(
+            query_or_object, batch_format, page_size, max_rows, columns, kwargs)
+        return columnar.concat(list(batches), schema, batch_format)
 
     def query_to_table(self, query_or_object, dataset_id,
                        table_id, write_disposition="WRITE_TRUNCATE",
-                       job_config=None, **kwargs):
-        """Execute a query in a especific table"""
+                       job_config=None, dry_run=False, **kwargs):
+        """Execute a query in a especific table.
+        With `dry_run` nothing is executed and the estimate of `dry_run` is returned"""
+        if dry_run:
+            return self.dry_run(query_or_object, job_config=job_config, **kwargs)
+        return self._wait(self.query_to_table_async(
+            query_or_object, dataset_id, table_id, write_disposition,
+            job_config, **kwargs))
+
+    def query_to_table_async(self, query_or_object, dataset_id,
+                             table_id, write_disposition="WRITE_TRUNCATE",
+                             job_config=None, **kwargs):
+        """Submit a query to a especific table and return its QueryJob without waiting"""
         job_config = job_config if job_config else bigquery.QueryJobConfig()
         table = self._client.dataset(dataset_id).table(table_id)
 
         job_config.destination = table
         job_config.write_disposition = write_disposition
 
-        return self.query(query_or_object, job_config=job_config, **kwargs)
+        return self.query_async(query_or_object, job_config=job_config, **kwargs)
+
+    def backfill(self, query_file_or_query, dataset_id, table_id, start_date, end_date,
+                 query_args=None, max_concurrent=4, retries=2, partitioned=False,
+                 write_disposition="WRITE_TRUNCATE", date_format=DEFAULT_DATE_FORMAT,
+                 poll_interval=5, params=()):
+        """Run a query to table for every day from start_date to end_date, both
+        included and formatted as `date_format`, with at most `max_concurrent`
+        jobs running at a time. Each day renders the query with `query_args` and
+        the previous_date, start_date and next_date of the day, and writes to
+        table_id formatted with {date}, or to the day partition of table_id when
+        `partitioned`. Vars named in `params` are sent as query parameters.
+        Failed days are retried up to `retries` times.
+        Returns a dict with the "succeeded" days, the "failed" ones mapped to
+        their last error and the number of "attempts" of each day.
+        An error submitting a day counts as a failed attempt of that day"""
+        if not partitioned and "{date}" not in table_id:
+            raise ValueError("Backfilling every day into {} would keep only one of them, "
+                             "use {{date}} in the table name or partitions".format(table_id))
+        first_day = datetime.strptime(start_date, date_format)
+        last_day = datetime.strptime(end_date, date_format)
+        days = [first_day + timedelta(offset) for offset in range((last_day - first_day).days + 1)]
+        template = query_file_or_query if isinstance(query_file_or_query, QueryBuilder) \
+            else QueryBuilder(query_file_or_query)
+
+        def submitter(day):
+            def submit():
+                day_string = day.strftime(date_format)
+                query_vars = dict(query_args or {})
+                query_vars.update(date_vars(day, date_format))
+                query = template.render(params=params, **query_vars)
+                table = table_id.format(date=day_string)
+                if partitioned:
+                    table = "{}${}".format(table, day_string)
+                try:
+                    job = self.query_to_table_async(query, dataset_id, table, write_disposition)
+                except Exception as error:  # pylint: disable=broad-except
+                    job = FailedSubmission(error)
+                submitted[id(job)] = day_string
+                return job
+            return submit
+
+        summary = {"succeeded": [], "failed": {}, "attempts": {}}
+        pending = days
+        for _ in range(retries + 1):
+            submitted = {}
+            failed_days = []
+            for job in as_completed([submitter(day) for day in pending],
+                                    max_concurrent=max_concurrent, poll_interval=poll_interval):
+                day_string = submitted[id(job)]
+                summary["attempts"][day_string] = summary["attempts"].get(day_string, 0) + 1
+                if job.error_result:
+                    self.logger.warning("Backfill of %s failed: %s", day_string, job.error_result)
+                    summary["failed"][day_string] = job.exception()
+                    failed_days.append(datetime.strptime(day_string, date_format))
+                else:
+                    summary["failed"].pop(day_string, None)
+                    summary["succeeded"].append(day_string)
+            pending = failed_days
+            if not pending:
+                break
+
+        summary["succeeded"].sort()
+        return summary
 
     def _complete_filename(self, filename, export_format, compression_format):
         if (self.COMPRESSION_FORMATS.get(compression_format) and
@@ -76,6 +353,15 @@ class Bigquery(BaseClient):
                                export_format="csv", compression_format="gz", location="US",
                                **kwargs):
         """Extract a table from BigQuery and send to GoogleStorage"""
+        return self._wait(self.table_to_cloud_storage_async(
+            dataset_id, table_id, bucket_name, filename, job_config,
+            export_format, compression_format, location, **kwargs))
+
+    def table_to_cloud_storage_async(self, dataset_id, table_id,
+                                     bucket_name, filename, job_config=None,
+                                     export_format="csv", compression_format="gz",
+                                     location="US", **kwargs):
+        """Submit a table extraction to GoogleStorage and return its ExtractJob without waiting"""
         complete_filename = self._complete_filename(
             filename, export_format, compression_format)
 
@@ -92,49 +378,158 @@ class Bigquery(BaseClient):
             table,
             destination_uri,
             location=location,
-            job_config=job_config, **kwargs).result()
+            job_config=job_config, **kwargs)
+
+    def _cached_metadata(self, key):
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.get(key)
+
+    def _cache_metadata(self, key, value):
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(key, value)
 
     def create_dataset(self, dataset_id):
-        """Create a dataset"""
+        """Create a dataset. When the metadata cache knows it exists no request
+        is made and the Dataset returned may only hold its reference"""
+        key = (self._client.project, dataset_id)
+        cached = self._cached_metadata(key)
         dataset = bigquery.Dataset(self._client.dataset(dataset_id))
-        return self._client.create_dataset(dataset, True)
-
-    def create_table(self, dataset_id, table_id):
-        """Create a table based on dataset"""
-        self.create_dataset(dataset_id)
+        if cached:
+            return cached if isinstance(cached, bigquery.Dataset) else dataset
+        dataset = self._client.create_dataset(dataset, True)
+        self._cache_metadata(key, dataset)
+        return dataset
 
+    def create_table(self, dataset_id, table_id, time_partitioning=None):
+        """Create a table based on dataset, partitioned as `time_partitioning`
+        when given. When the metadata cache knows it exists no request is made
+        and the Table returned may only hold its reference"""
+        key = (self._client.project, dataset_id, table_id)
+        cached = self._cached_metadata(key)
         dataset_ref = self._client.dataset(dataset_id)
         table_ref = dataset_ref.table(table_id)
         table = bigquery.Table(table_ref)
-        return self._client.create_table(table, True)
+        table.time_partitioning = time_partitioning
+        if cached:
+            return cached if isinstance(cached, bigquery.Table) else table
+        self.create_dataset(dataset_id)
+
+        table = self._client.create_table(table, True)
+        self._cache_metadata(key, table)
+        return table
+
+    def prefetch_tables(self, dataset_id, project_id=None):
+        """List the tables of a dataset in one call and cache them, so checks
+        and creates of its tables need no request until the cache expires"""
+        if self.metadata_cache is None:
+            raise ValueError("prefetch_tables requires a metadata_cache")
+        tables = self._client.list_tables(self._client.dataset(dataset_id, project=project_id))
+        self.metadata_cache.set_tables(
+            project_id or self._client.project, dataset_id,
+            [(table.table_id, table) for table in tables])
+
+    def _source_uris(self, bucket_name, filename):
+        filenames = list(filename) if isinstance(filename, (list, tuple)) else [filename]
+        return [name if name.startswith("gs://") else "gs://{}/{}".format(bucket_name, name)
+                for name in filenames]
 
     def cloud_storage_to_table(self, bucket_name, filename,
                                dataset_id, table_id, job_config=None,
-                               import_format="csv", location="US", **kwargs):
-        """Extract table from GoogleStorage and send to BigQuery"""
-        self.create_table(dataset_id, table_id)
+                               import_format="csv", location="US", partition=None,
+                               uris_per_job=MAX_LOAD_URIS, max_concurrent=4, **kwargs):
+        """Extract table from GoogleStorage and send to BigQuery.
+        `filename` is a name, a gs:// URI or a list of them, wildcards included.
+        For a list the finished load jobs are returned as a list, whatever the
+        number of URIs. More than `uris_per_job` URIs are split into load jobs
+        running at most `max_concurrent` at a time; with WRITE_TRUNCATE the
+        first job truncates and the others append"""
+        uris = self._source_uris(bucket_name, filename)
+        if not isinstance(filename, (list, tuple)):
+            return self._wait(self.cloud_storage_to_table_async(
+                bucket_name, uris, dataset_id, table_id, job_config,
+                import_format, location, partition, **kwargs))
+        if len(uris) <= uris_per_job:
+            job = self.cloud_storage_to_table_async(
+                bucket_name, uris, dataset_id, table_id, job_config,
+                import_format, location, partition, **kwargs)
+            self._wait(job)
+            return [job]
 
-        dataset_ref = self._client.dataset(dataset_id)
-        table_ref = dataset_ref.table(table_id)
+        job_config = job_config if job_config else bigquery.LoadJobConfig()
+        chunks = [uris[start:start + uris_per_job] for start in range(0, len(uris), uris_per_job)]
+        if job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE:
+            first_job = self.cloud_storage_to_table_async(
+                bucket_name, chunks.pop(0), dataset_id, table_id, job_config,
+                import_format, location, partition, **kwargs)
+            self._wait(first_job)
+            job_config = bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr())
+            job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+        else:
+            first_job = None
+
+        def submitter(chunk):
+            return lambda: self.cloud_storage_to_table_async(
+                bucket_name, chunk, dataset_id, table_id,
+                bigquery.LoadJobConfig.from_api_repr(job_config.to_api_repr()),
+                import_format, location, partition, **kwargs)
+
+        jobs = wait_all([submitter(chunk) for chunk in chunks], max_concurrent=max_concurrent)
+        return ([first_job] if first_job is not None else []) + jobs
+
+    def cloud_storage_to_table_async(self, bucket_name, filename,
+                                     dataset_id, table_id, job_config=None,
+                                     import_format="csv", location="US", partition=None,
+                                     **kwargs):
+        """Submit a load from GoogleStorage to BigQuery and return its LoadJob without waiting.
+        With `partition`, a YYYYMMDD date, or a table_id decorated as table$YYYYMMDD
+        the load targets that partition of the table, which is created when
+        missing with the time partitioning of job_config, daily by default"""
+        uris = self._source_uris(bucket_name, filename)
+        if len(uris) > MAX_LOAD_URIS:
+            raise ValueError("A load job reads at most {} URIs".format(MAX_LOAD_URIS))
 
+        table_id, _, decorator = table_id.partition("$")
+        partition = partition or decorator
         job_config = job_config if job_config else bigquery.LoadJobConfig()
+        if partition:
+            self.create_table(dataset_id, table_id, job_config.time_partitioning or
+                              bigquery.TimePartitioning(bigquery.TimePartitioningType.DAY))
+        else:
+            self.create_table(dataset_id, table_id)
+
+        dataset_ref = self._client.dataset(dataset_id)
+        table_ref = dataset_ref.table(
+            "{}${}".format(table_id, partition) if partition else table_id)
+
         job_config.source_format = self.FILE_FORMATS.get(import_format)
 
         return self._client.load_table_from_uri(
-            "gs://{}/{}".format(bucket_name, filename),
+            uris[0] if len(uris) == 1 else uris,
             table_ref,
             job_config=job_config,
             location=location,
             **kwargs
-        ).result()
+        )
+
+    def row_writer(self, dataset_id, table_id, **kwargs):
+        """Return a RowWriter buffering rows for a table, see RowWriter for
+        the flush and retry options"""
+        table_ref = self._client.dataset(dataset_id).table(table_id)
+        return RowWriter(self._client, table_ref, **kwargs)
 
     def table_exists(self, table_id, dataset_id, project_id=None):
         """Check if tables exists"""
+        key = (project_id or self._client.project, dataset_id, table_id)
+        cached = self._cached_metadata(key)
+        if cached is not None:
+            return bool(cached)
         client = bigquery.Client(project_id) if project_id else self._client
         dataset = client.dataset(dataset_id)
         table = dataset.table(table_id)
         try:
-            self._client.get_table(table)
+            self._cache_metadata(key, self._client.get_table(table))
             return True
         except NotFound:
+            self._cache_metadata(key, False)
             return False
@@ -0,0 +1,175 @@
+"""Module to decode BigQuery result pages into columns"""
+from google.cloud.bigquery._helpers import _row_tuple_from_json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+BATCH_FORMATS = ("numpy", "arrow", "pandas")
+_NESTED_TYPES = ("RECORD", "STRUCT")
+
+
+def _replace_nulls(values, null):
+    return [null if value is None else value for value in values]
+
+
+def _integer_column(values):
+    if None in values:
+        return numpy.array(_replace_nulls(values, "nan")).astype(numpy.float64)
+    return numpy.array(values).astype(numpy.int64)
+
+
+def _float_column(values):
+    return numpy.array(_replace_nulls(values, "nan")).astype(numpy.float64)
+
+
+def _boolean_column(values):
+    if None in values:
+        return numpy.array([None if value is None else value == "true" for value in values],
+                           dtype=object)
+    return numpy.array(values) == "true"
+
+
+def _timestamp_column(values):
+    seconds = _float_column(values)
+    microseconds = numpy.round(seconds * 1e6)
+    column = numpy.where(numpy.isnan(microseconds), 0, microseconds)\
+        .astype(numpy.int64).astype("datetime64[us]")
+    column[numpy.isnan(microseconds)] = numpy.datetime64("NaT")
+    return column
+
+
+def _date_column(values):
+    return numpy.array(_replace_nulls(values, "NaT"), dtype="datetime64[D]")
+
+
+def _object_column(values):
+    # Built element by element, as numpy.array makes lists of one length 2-D
+    column = numpy.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        column[index] = value
+    return column
+
+
+def _nested_column(values, field):
+    return _object_column([_row_tuple_from_json({"f": [{"v": value}]}, [field])[0]
+                           for value in values])
+
+
+_DECODERS = {
+    "INTEGER": _integer_column,
+    "INT64": _integer_column,
+    "FLOAT": _float_column,
+    "FLOAT64": _float_column,
+    "BOOLEAN": _boolean_column,
+    "BOOL": _boolean_column,
+    "TIMESTAMP": _timestamp_column,
+    "DATE": _date_column,
+}
+
+
+def decode_page(raw_rows, schema):
+    """Decode the raw JSON rows of a result page into a dict of NumPy arrays,
+    converting each column at once. Integers with nulls become floats with
+    NaN, null timestamps and dates NaT. Repeated and record fields become
+    object arrays of lists and dicts of decoded values, any other type object
+    arrays of the raw values"""
+    if numpy is None:
+        raise ImportError("numpy is required to fetch columnar results")
+    cells = [row["f"] for row in raw_rows]
+    columns = {}
+    for index, field in enumerate(schema):
+        values = [cell[index]["v"] for cell in cells]
+        if field.mode == "REPEATED" or field.field_type in _NESTED_TYPES:
+            columns[field.name] = _nested_column(values, field)
+        else:
+            columns[field.name] = _DECODERS.get(field.field_type, _object_column)(values)
+    return columns
+
+
+def _scalar_arrow_type(field_type, nested):
+    types = {
+        "INTEGER": pyarrow.int64(), "INT64": pyarrow.int64(),
+        "FLOAT": pyarrow.float64(), "FLOAT64": pyarrow.float64(),
+        "BOOLEAN": pyarrow.bool_(), "BOOL": pyarrow.bool_(),
+        "TIMESTAMP": pyarrow.timestamp("us"), "DATE": pyarrow.date32(),
+    }
+    if nested:
+        # Nested values are decoded to Python objects rather than kept raw
+        types.update({
+            "TIMESTAMP": pyarrow.timestamp("us", tz="UTC"), "DATETIME": pyarrow.timestamp("us"),
+            "TIME": pyarrow.time64("us"), "BYTES": pyarrow.binary(),
+            "NUMERIC": pyarrow.decimal128(38, 9),
+        })
+    return types.get(field_type, pyarrow.string())
+
+
+def _arrow_type(field, nested=False):
+    if field.field_type in _NESTED_TYPES:
+        arrow_type = pyarrow.struct([(sub_field.name, _arrow_type(sub_field, True))
+                                     for sub_field in field.fields])
+    else:
+        arrow_type = _scalar_arrow_type(field.field_type, nested or field.mode == "REPEATED")
+    if field.mode == "REPEATED":
+        return pyarrow.list_(arrow_type)
+    return arrow_type
+
+
+def _arrow_column(column, field):
+    arrow_type = _arrow_type(field)
+    if field.mode == "REPEATED" or field.field_type in _NESTED_TYPES:
+        return pyarrow.array(list(column), type=arrow_type)
+    array = pyarrow.array(column, from_pandas=True)
+    if array.type != arrow_type:
+        array = array.cast(arrow_type)
+    return array
+
+
+def to_format(columns, schema, batch_format):
+    """Convert a dict of NumPy arrays into the requested batch format:
+    the dict itself, an Arrow RecordBatch typed after the schema, so batches of
+    one result always match, or a pandas DataFrame"""
+    names = [field.name for field in schema]
+    if batch_format == "numpy":
+        return columns
+    if batch_format == "arrow":
+        if pyarrow is None:
+            raise ImportError("pyarrow is required to fetch Arrow record batches")
+        return pyarrow.RecordBatch.from_arrays(
+            [_arrow_column(columns[field.name], field) for field in schema], names)
+    if batch_format == "pandas":
+        if pandas is None:
+            raise ImportError("pandas is required to fetch DataFrames")
+        return pandas.DataFrame(columns, columns=names)
+    raise ValueError("Only valid batch formats: {}".format(",".join(BATCH_FORMATS)))
+
+
+def concat(batches, schema, batch_format):
+    """Join the batches yielded for a result into a single object:
+    a dict of NumPy arrays, an Arrow Table or a pandas DataFrame"""
+    names = [field.name for field in schema]
+    if batch_format == "numpy":
+        if not batches:
+            return dict((name, numpy.array([])) for name in names)
+        return dict((name, numpy.concatenate([batch[name] for batch in batches]))
+                    for name in names)
+    if batch_format == "arrow":
+        if not batches:
+            return pyarrow.schema(
+                [(field.name, _arrow_type(field)) for field in schema]
+            ).empty_table()
+        return pyarrow.Table.from_batches(batches)
+    if not batches:
+        return pandas.DataFrame(columns=names)
+    return pandas.concat(batches, ignore_index=True)
@@ -0,0 +1,105 @@
+"""Module to wait on many BigQuery jobs running concurrently"""
+import time
+
+from gcloud_utils.bigquery.accounting import ACCOUNTING
+
+
+class JobTimeout(Exception):
+    """Raised when jobs do not finish within the given timeout"""
+
+
+class FailedSubmission(object):
+    """Stands for a job whose submission raised, finished with that error"""
+
+    state = "DONE"
+
+    def __init__(self, error):
+        self.error = error
+        self.error_result = {"reason": "submissionFailed", "message": str(error)}
+
+    def done(self):
+        """Always finished"""
+        return True
+
+    def reload(self):
+        """Nothing to refresh"""
+
+    def exception(self):
+        """The error raised by the submission"""
+        return self.error
+
+
+def _finished(job):
+    """Poll a job with a quick jobs.get. done() is avoided as, for query jobs,
+    it waits on getQueryResults which the server may hold for seconds"""
+    job.reload()
+    return job.state == "DONE"
+
+
+def _submit(job_or_submitter):
+    if callable(job_or_submitter) and not hasattr(job_or_submitter, "done"):
+        return job_or_submitter()
+    return job_or_submitter
+
+
+def as_completed(jobs, timeout=None, max_concurrent=None, poll_interval=1.0):
+    """Yield BigQuery jobs as they finish, failed or not.
+
+    `jobs` holds jobs already submitted, such as the ones returned by the
+    Bigquery *_async methods, or zero-argument callables that submit one and
+    return it. Callables are only called while fewer than `max_concurrent` of
+    the jobs are running, which keeps many jobs within the project quota.
+    Finished jobs are recorded in the job accounting.
+    Raises JobTimeout when the jobs are not done after `timeout` seconds"""
+    pending = list(jobs)
+    pending.reverse()
+    running = []
+    deadline = None if timeout is None else time.time() + timeout
+
+    while pending or running:
+        while pending and (max_concurrent is None or len(running) < max_concurrent):
+            running.append(_submit(pending.pop()))
+
+        still_running = []
+        for job in running:
+            if _finished(job):
+                if not isinstance(job, FailedSubmission):
+                    ACCOUNTING.record(job)
+                yield job
+            else:
+                still_running.append(job)
+        running = still_running
+
+        if running:
+            if deadline is not None and time.time() >= deadline:
+                raise JobTimeout("{} jobs still running after {} seconds".format(
+                    len(running) + len(pending), timeout))
+            time.sleep(poll_interval)
+
+
+def wait_all(jobs, timeout=None, max_concurrent=None, poll_interval=1.0, raise_errors=True):
+    """Wait for all jobs, see `as_completed`, and return them in the given order.
+    With `raise_errors` the error of the first failed job is raised once every
+    job is finished"""
+    jobs = list(jobs)
+    submitted = {}
+    indexes = {}
+
+    def submitter(index, job_or_submitter):
+        def submit():
+            job = _submit(job_or_submitter)
+            indexes[id(job)] = index
+            return job
+        return submit
+
+    finished = as_completed([submitter(index, job) for index, job in enumerate(jobs)],
+                            timeout, max_concurrent, poll_interval)
+    for job in finished:
+        submitted[indexes[id(job)]] = job
+
+    result = [submitted[index] for index in range(len(jobs))]
+    if raise_errors:
+        for job in result:
+            if job.error_result:
+                raise job.exception()
+    return result
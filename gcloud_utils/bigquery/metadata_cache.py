@@ -0,0 +1,75 @@
+"""Module to cache the existence of BigQuery datasets and tables"""
+import time
+import threading
+
+DEFAULT_TTL = 300
+DEFAULT_NEGATIVE_TTL = 0
+
+
+class MetadataCache(object):
+    """Cache of datasets and tables known to exist or not, keyed by
+    (project, dataset) and (project, dataset, table), expiring after `ttl`
+    seconds. Missing entries are cached as False for `negative_ttl` seconds,
+    not at all by default, so loops waiting for a table see it appear.
+
+    When the table list of a dataset was stored with `set_tables`, tables out
+    of it are reported missing without a request for `negative_ttl` seconds"""
+
+    def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, stored):
+        if stored is None:
+            return False
+        age = time.time() - stored[0]
+        return age <= self.ttl if stored[1] else age < self.negative_ttl
+
+    def get(self, key):
+        """Return the cached metadata of key, False when known to be missing,
+        or None when unknown or expired"""
+        with self._lock:
+            stored = self._entries.get(key)
+            if self._fresh(stored):
+                value = stored[1]
+            elif len(key) == 3 and self._fresh(self._listings.get(key[:2])):
+                value = False
+            else:
+                value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache the metadata of key, False when it does not exist"""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+
+    def set_tables(self, project, dataset_id, tables):
+        """Cache the complete table list of a dataset, as (table_id, metadata) pairs"""
+        now = time.time()
+        with self._lock:
+            self._entries[(project, dataset_id)] = (now, True)
+            for table_id, value in tables:
+                self._entries[(project, dataset_id, table_id)] = (now, value)
+            # A list stands for the absence of every table out of it
+            self._listings[(project, dataset_id)] = (now, False)
+
+    def invalidate(self, project=None, dataset_id=None, table_id=None):
+        """Drop the entries matching the given project, dataset and table,
+        None matching any, along with the table list of their datasets"""
+        parts = (project, dataset_id, table_id)
+        with self._lock:
+            # Dataset lists are matched on project and dataset only, as a
+            # dropped table may exist now
+            for entries in (self._entries, self._listings):
+                for key in list(entries):
+                    if all(part is None or part == value for part, value in zip(parts, key)):
+                        del entries[key]
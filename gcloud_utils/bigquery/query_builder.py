@@ -1,28 +1,216 @@
 """Module to build query"""
+import os
+import re
+import datetime
+import threading
+from collections import OrderedDict
 from string import Template
 
+from google.cloud import bigquery
+
+DEFAULT_MAX_TEMPLATES = 256
+MAX_ANALYZED_QUERIES = 64
+
+_LITERALS_AND_COMMENTS = re.compile(
+    r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|/\*.*?\*/|--[^\n]*|#[^\n]*", re.DOTALL)
+_FUNCTION_FROM = re.compile(r"(\b(?:EXTRACT|TRIM|SUBSTRING)\s*\([^()]*?)\bFROM\b", re.IGNORECASE)
+_KEYWORDS = ("SELECT", "WHERE", "GROUP", "ORDER", "LIMIT", "HAVING", "WINDOW", "QUALIFY",
+             "UNION", "INTERSECT", "EXCEPT", "ON", "USING", "JOIN", "INNER", "LEFT", "RIGHT",
+             "FULL", "CROSS", "FOR", "TABLESAMPLE", "PIVOT", "UNPIVOT")
+_REFERENCE = r"(`[^`]+`|\[[^\]]+\]|[\w\-]+(?:[.:][\w\-\*\$]+)+)" \
+    r"(?:\s+(?:AS\s+)?(?!(?:" + "|".join(_KEYWORDS) + r")\b)(\w+))?"
+_TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+" + _REFERENCE, re.IGNORECASE)
+_NEXT_TABLE_REFERENCE = re.compile(r"\s*,\s*" + _REFERENCE, re.IGNORECASE)
+
+
+def _parameter_type(value):
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, int):
+        return "INT64"
+    if isinstance(value, float):
+        return "FLOAT64"
+    if isinstance(value, datetime.datetime):
+        return "DATETIME" if value.tzinfo is None else "TIMESTAMP"
+    if isinstance(value, datetime.date):
+        return "DATE"
+    return "STRING"
+
+
+class CompiledTemplate(object):
+    """A query template parsed once into literal parts and placeholders, with
+    the same syntax and missing-var behaviour as Template.safe_substitute"""
+
+    def __init__(self, text):
+        self.text = text
+        self.names = []
+        self._parts = []
+        position = 0
+        for match in Template.pattern.finditer(text):
+            start, end = match.span()
+            name = match.group("named") or match.group("braced")
+            if match.group("escaped") is not None:
+                self._parts.append(text[position:start] + Template.delimiter)
+            elif name is None:
+                self._parts.append(text[position:end])
+            else:
+                quote = text[start - 1] if start > position and text[start - 1] in "'\"" else ""
+                if quote and text[end:end + 1] != quote:
+                    quote = ""
+                self._parts.append(text[position:start - len(quote)])
+                self._parts.append((name, quote, text[start - len(quote):end + len(quote)]))
+                if name not in self.names:
+                    self.names.append(name)
+                end += len(quote)
+            position = end
+        self._parts.append(text[position:])
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def tables(self, query):
+        """Return the tables a rendering of this template reads after FROM and
+        JOIN, comma separated lists included, as dataset.table or
+        project.dataset.table in order of appearance. FROM inside EXTRACT and
+        TRIM, array paths of a table alias and references still holding
+        placeholders are left out. The result of each rendering is cached, so
+        repeated checks cost nothing"""
+        with self._lock:
+            if query in self._tables:
+                return list(self._tables[query])
+
+        tables = []
+        aliases = set()
+        text = _FUNCTION_FROM.sub(r"\1 ", _LITERALS_AND_COMMENTS.sub(" ", query))
+        for match in _TABLE_REFERENCE.finditer(text):
+            while match:
+                table = match.group(1).strip("`[]").replace(":", ".")
+                if "." in table and Template.delimiter not in table and table not in tables \
+                        and table.split(".")[0].lower() not in aliases:
+                    tables.append(table)
+                if match.group(2):
+                    aliases.add(match.group(2).lower())
+                match = _NEXT_TABLE_REFERENCE.match(text, match.end())
+
+        with self._lock:
+            self._tables[query] = tables
+            while len(self._tables) > MAX_ANALYZED_QUERIES:
+                self._tables.popitem(last=False)
+        return list(tables)
+
+    def render(self, mapping, params=()):
+        """Return the query with the vars of mapping filled in and its list of
+        query parameters. Vars named in `params` become @name parameters,
+        dropping the quotes around their placeholder; missing vars are kept"""
+        query = []
+        parameters = []
+        for part in self._parts:
+            if not isinstance(part, tuple):
+                query.append(part)
+                continue
+            name, quote, raw = part
+            if name not in mapping:
+                query.append(raw)
+            elif name in params:
+                query.append("@" + name)
+                if name not in [parameter.name for parameter in parameters]:
+                    value = mapping[name]
+                    parameters.append(bigquery.ScalarQueryParameter(
+                        name, _parameter_type(value), value))
+            else:
+                query.append("%s%s%s" % (quote, mapping[name], quote))
+        return "".join(query), parameters
+
+
+class TemplateRegistry(object):
+    """LRU registry of compiled templates, keyed by path and modification
+    time for files, so an edited file is compiled again, and by text for
+    queries"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_TEMPLATES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(file_or_query):
+        try:
+            return ("file", file_or_query, os.stat(file_or_query).st_mtime)
+        except (OSError, ValueError, TypeError):
+            return ("query", file_or_query)
+
+    @staticmethod
+    def _load(file_or_query):
+        try:
+            with open(file_or_query) as filebuffer:
+                return filebuffer.read().replace('\n', ' ').replace('\r', '')
+        except (IOError, OSError, ValueError, TypeError):
+            return file_or_query
+
+    def get(self, file_or_query):
+        """Return the compiled template of a query file or query string"""
+        key = self._key(file_or_query)
+        with self._lock:
+            template = self._templates.pop(key, None)
+            if template is not None:
+                self._templates[key] = template
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        template = CompiledTemplate(self._load(file_or_query))
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        """Drop every compiled template"""
+        with self._lock:
+            self._templates.clear()
+
+
+TEMPLATES = TemplateRegistry()
+
 
 class QueryBuilder(object):
     """Query Builder class to load a query from a file or from a string"""
 
-    def __init__(self, file_or_query):
+    def __init__(self, file_or_query, registry=TEMPLATES):
         self._file_or_query = file_or_query
-        self._query = self._load_query()
+        self._registry = registry
+        self._template = registry.get(file_or_query)
+        self._vars = {}
+        self._query = self._template.text
+        self.query_parameters = []
 
     @property
     def query(self):
         """Return the query from file/string"""
         return self._query
 
-    def _load_query(self):
-        try:
-            with open(self._file_or_query) as filebuffer:
-                query = filebuffer.read().replace('\n', ' ').replace('\r', '')
-        except IOError:
-            query = self._file_or_query
-        return query
-
-    def with_vars(self, **kwargs):
-        """Fill the query with vars"""
-        template = Template(self._query)
-        self._query = template.safe_substitute(kwargs)
+    def with_vars(self, params=(), **kwargs):
+        """Fill the query with vars, sending those named in `params` as query parameters"""
+        self._vars.update(kwargs)
+        self._query, self.query_parameters = self._template.render(self._vars, params)
+
+    @property
+    def unresolved(self):
+        """Names of the placeholders no var was given for"""
+        return [name for name in self._template.names if name not in self._vars]
+
+    def analyze(self):
+        """Return a dict with the "unresolved" placeholders and the "tables"
+        the query reads, checked without any request to BigQuery"""
+        return {"unresolved": self.unresolved, "tables": self._template.tables(self._query)}
+
+    def render(self, params=(), **kwargs):
+        """Return a new QueryBuilder filled with the vars of this one and
+        kwargs, leaving this one unchanged. Vars named in `params` are sent as
+        BigQuery query parameters, which keeps the query text identical across
+        values so BigQuery can reuse cached results"""
+        rendered = QueryBuilder(self._file_or_query, self._registry)
+        rendered.with_vars(params, **dict(self._vars, **kwargs))
+        return rendered
@@ -0,0 +1,203 @@
+"""Module to cache BigQuery query results on the client side"""
+import os
+import re
+import json
+import time
+import errno
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_MAX_ROWS = 1000000
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+_QUOTED = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`")
+
+
+def normalize_query(query):
+    """Collapse whitespace out of quoted literals and identifiers and drop the
+    trailing semicolon of a query, so renderings differing only in layout
+    share a cache entry"""
+    parts = []
+    position = 0
+    for match in _QUOTED.finditer(query):
+        parts.append(re.sub(r"\s+", " ", query[position:match.start()]))
+        parts.append(match.group())
+        position = match.end()
+    parts.append(re.sub(r"\s+", " ", query[position:]))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+class MemoryBackend(object):
+    """In-process cache backend keeping at most `max_entries` entries holding
+    `max_rows` rows in total, evicting the least recently used. Results with
+    more rows than that are not kept"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_rows=DEFAULT_MAX_ROWS):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(entry):
+        return len(entry["rows"]) if isinstance(entry, dict) and "rows" in entry else 1
+
+    def get(self, key):
+        """Return the entry of key or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        """Store an entry, evicting the least recently used ones"""
+        with self._lock:
+            self._pop(key)
+            if self._size(entry) > self.max_rows:
+                return
+            self._entries[key] = entry
+            self._rows += self._size(entry)
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._rows -= self._size(entry)
+
+    def delete(self, key):
+        """Remove the entry of key if present"""
+        with self._lock:
+            self._pop(key)
+
+
+class DiskBackend(object):
+    """On-disk cache backend storing pickled entries under `directory`, shared
+    by processes of the host. Files are written atomically and the least
+    recently used are evicted when they take more than `max_bytes`"""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """Return the entry of key or None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as entry_file:
+                entry = pickle.load(entry_file)
+            os.utime(path, None)
+            return entry
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry):
+        """Store an entry, evicting the least recently used ones"""
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(handle, "wb") as entry_file:
+            pickle.dump(entry, entry_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._path(key))
+        self._evict()
+
+    def delete(self, key):
+        """Remove the entry of key if present"""
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.delete(name[:-len(".pickle")])
+            total -= size
+
+
+class QueryCache(object):
+    """Cache of query results keyed by the normalized query text and job config.
+
+    Entries expire after `ttl` seconds and are invalidated when any table the
+    query read has been modified since, checked with one metadata request per
+    table. Results are stored in `backend`, a MemoryBackend by default"""
+
+    def __init__(self, backend=None, ttl=DEFAULT_TTL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(kwargs):
+        """Queries writing to a destination table are never cached, nor are
+        statements other than SELECT, checked once their job is done"""
+        job_config = kwargs.get("job_config")
+        return job_config is None or getattr(job_config, "destination", None) is None
+
+    @staticmethod
+    def key(query, kwargs):
+        """Key of a query text and the arguments of its job"""
+        job_config = kwargs.get("job_config")
+        config = job_config.to_api_repr() if job_config is not None else None
+        extra = dict((name, value) for name, value in kwargs.items()
+                     if name not in ("job_config", "job_id", "job_id_prefix", "query"))
+        payload = json.dumps([normalize_query(query), config, extra],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _modified(client, table):
+        return client.get_table(table).modified
+
+    def get(self, key, client):
+        """Return the cached rows of key, or None when missing, expired or
+        when one of its source tables changed"""
+        entry = self.backend.get(key)
+        if entry is not None and time.time() - entry["created"] > self.ttl:
+            entry = None
+        if entry is not None:
+            for table, modified in entry["tables"]:
+                if self._modified(client, table) != modified:
+                    entry = None
+                    break
+        if entry is None:
+            self.backend.delete(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["rows"]
+
+    def set(self, key, rows, tables, client):
+        """Cache the rows of a query along with the last modification of the
+        tables it read"""
+        self.backend.set(key, {
+            "created": time.time(),
+            "rows": rows,
+            "tables": [(table, self._modified(client, table)) for table in tables or ()]
+        })
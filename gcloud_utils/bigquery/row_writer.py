@@ -0,0 +1,184 @@
+"""Module to write rows to a BigQuery table in micro-batches"""
+import io
+import json
+import time
+import uuid
+import logging
+import threading
+
+from google.cloud import bigquery
+
+from gcloud_utils.bigquery.accounting import ACCOUNTING
+
+WRITE_METHODS = ("insert_all", "load")
+DEFAULT_MAX_ROWS = 500
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+
+
+class RowWriter(object):
+    """Buffer rows for a table and send them in batches, through insertAll
+    streaming requests or through load jobs reading from memory.
+
+    Rows are dicts or tuples ordered as the table schema, fetched once when no
+    `schema` is given. The buffer is flushed when it holds `max_rows` rows or
+    `max_bytes` bytes of JSON, and on close. There is no timer: `max_latency`
+    is only checked when a row is written, so the last rows of a stream that
+    stops wait for the next write, a flush or close.
+    insertAll rejects a whole request when any row is invalid: invalid rows
+    are kept in `failed_rows` with their errors at once, and only the rows
+    stopped with them or failing for other reasons are retried, up to
+    `retries` times. A failed request or load job, raising an error, is
+    retried whole; rows still failing are kept in `failed_rows` too."""
+
+    def __init__(self, client, table, schema=None, method="insert_all",
+                 max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_latency=None, retries=3, retry_delay=1.0):
+        if method not in WRITE_METHODS:
+            raise ValueError("Only valid write methods: {}".format(",".join(WRITE_METHODS)))
+        self._client = client
+        self.table = table
+        self.method = method
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failed_rows = []
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.elapsed = 0.0
+        self._schema = schema
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+        self.logger = logging.getLogger(name=self.__class__.__name__)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def schema(self):
+        """Schema of the table, fetched on first use when not given"""
+        if self._schema is None:
+            self._schema = self._client.get_table(self.table).schema
+        return self._schema
+
+    def _as_dict(self, row):
+        if isinstance(row, dict):
+            return row
+        return dict((field.name, value) for field, value in zip(self.schema, row))
+
+    def write(self, row):
+        """Buffer a row, flushing when the buffer is full or too old"""
+        row = self._as_dict(row)
+        size = len(json.dumps(row, default=str))
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._buffer.append(row)
+            self._buffer_bytes += size
+            if len(self._buffer) >= self.max_rows or self._buffer_bytes >= self.max_bytes or \
+                    (self.max_latency is not None and
+                     time.time() - self._oldest >= self.max_latency):
+                self.flush()
+
+    def write_many(self, rows):
+        """Buffer every row of an iterable"""
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """Send every buffered row and return the number of rows written"""
+        with self._lock:
+            rows, size = self._buffer, self._buffer_bytes
+            self._buffer, self._buffer_bytes, self._oldest = [], 0, None
+            if not rows:
+                return 0
+            start = time.time()
+            if self.method == "insert_all":
+                failed = self._insert_all(rows)
+            else:
+                failed = self._load(rows, size)
+            self.elapsed += time.time() - start
+            self.flushes += 1
+            self.failed_rows.extend(failed)
+            self.rows_written += len(rows) - len(failed)
+            self.bytes_written += size - sum(
+                len(json.dumps(row, default=str)) for row, _ in failed)
+            return len(rows) - len(failed)
+
+    def close(self):
+        """Flush the remaining rows"""
+        self.flush()
+
+    def _insert_all(self, rows):
+        # Insert ids are kept between retries, so BigQuery deduplicates rows
+        # accepted in a request that was partially rejected
+        pending = [(str(uuid.uuid4()), row, None) for row in rows]
+        failed = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                errors = self._client.insert_rows(
+                    self.table, [row for _, row, _ in pending], selected_fields=self.schema,
+                    row_ids=[row_id for row_id, _, _ in pending])
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.warning("Insert of %s rows to %s failed: %s", len(pending),
+                                    self.table, exc)
+                pending = [(row_id, row, [str(exc)]) for row_id, row, _ in pending]
+                continue
+            if not errors:
+                return failed
+            self.logger.warning("%s of %s rows rejected by %s", len(errors), len(pending),
+                                self.table)
+            rejected = []
+            for error in sorted(errors, key=lambda error: error["index"]):
+                row_id, row, _ = pending[error["index"]]
+                if any(reason.get("reason") == "invalid" for reason in error["errors"]):
+                    failed.append((row, error["errors"]))
+                else:
+                    rejected.append((row_id, row, error["errors"]))
+            pending = rejected
+            if not pending:
+                return failed
+        return failed + [(row, row_errors) for _, row, row_errors in pending]
+
+    def _load(self, rows, size):
+        data = "\n".join(json.dumps(row, default=str) for row in rows).encode("utf-8")
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = "NEWLINE_DELIMITED_JSON"
+        job_config.write_disposition = "WRITE_APPEND"
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                job_config.schema = self.schema
+                job = self._client.load_table_from_file(
+                    io.BytesIO(data), self.table, job_config=job_config)
+                job.result()
+                ACCOUNTING.record(job)
+                return []
+            except Exception as exc:  # pylint: disable=broad-except
+                error = exc
+                self.logger.warning("Load of %s rows (%s bytes) to %s failed: %s",
+                                    len(rows), size, self.table, exc)
+        return [(row, [str(error)]) for row in rows]
+
+    @property
+    def stats(self):
+        """Throughput counters of this writer"""
+        return {
+            "rows_written": self.rows_written,
+            "rows_failed": len(self.failed_rows),
+            "bytes_written": self.bytes_written,
+            "flushes": self.flushes,
+            "elapsed": self.elapsed,
+            "rows_per_second": self.rows_written / self.elapsed if self.elapsed else 0.0,
+        }
@@ -0,0 +1,138 @@
+"""Module to keep a local on-disk cache of Google Storage blobs"""
+import os
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return False
+
+
+class BlobCache(object):
+    """LRU cache of blob contents keyed by bucket, name and generation.
+
+    Every cached generation is a file under `cache_dir`, written to a temporary
+    file and atomically renamed into place, so several processes can share the
+    same directory. Recency is tracked through the file modification time,
+    touched on every hit, and the least recently used files are evicted once
+    the cache grows over `max_bytes`.
+    When `revalidate` is set a metadata request checks that the cached
+    generation is still the live one, otherwise any cached generation is served
+    without network access."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, revalidate=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(name=self.__class__.__name__)
+
+    def _blob_dir(self, bucket, name):
+        key = hashlib.sha1("{}/{}".format(bucket, name).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _latest_generation(self, blob_dir):
+        try:
+            generations = [entry for entry in os.listdir(blob_dir) if entry.isdigit()]
+        except OSError:
+            return None
+        return max(generations, key=int) if generations else None
+
+    def path_for(self, bucket, name, generation=None):
+        """Return the cached file of a blob generation, or of its most recent
+        cached generation when `generation` is None, and mark it as used.
+        Returns None when it is not cached"""
+        blob_dir = self._blob_dir(bucket, name)
+        if generation is None:
+            generation = self._latest_generation(blob_dir)
+            if generation is None:
+                return None
+        path = os.path.join(blob_dir, str(generation))
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def store(self, bucket, name, generation, download):
+        """Store a blob generation calling download(file_obj) to write its
+        contents, evict older entries if needed and return the cached file"""
+        with self._lock:
+            self.misses += 1
+        blob_dir = self._blob_dir(bucket, name)
+        if not os.path.exists(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        path = os.path.join(blob_dir, str(generation))
+        handle, temp_path = tempfile.mkstemp(dir=blob_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                download(temp_file)
+            os.rename(temp_path, path)
+        except Exception:
+            _remove(temp_path)
+            raise
+        for entry in os.listdir(blob_dir):
+            if entry.isdigit() and entry != str(generation):
+                _remove(os.path.join(blob_dir, entry))
+        self.evict(keep=path)
+        return path
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for entry in files:
+                if entry.isdigit():
+                    path = os.path.join(root, entry)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def size(self):
+        """Total bytes stored in the cache"""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache fits in max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            if _remove(path):
+                with self._lock:
+                    self.evictions += 1
+                self.logger.debug("Evicted %s from blob cache", path)
+            total -= size
+
+    def clear(self):
+        """Remove every cached file"""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    @property
+    def stats(self):
+        """Hit, miss and eviction counters of this instance"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,209 @@
+"""Module to stream Google Storage blobs as file-like objects"""
+import io
+import zlib
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+RESUMABLE_CHUNK_MULTIPLE = 256 * 1024
+
+
+class BlobReader(io.RawIOBase):
+    """Read-only, seekable file-like object over a blob.
+    Data is fetched lazily with ranged requests of at most `chunk_size` bytes,
+    so nothing touches the disk"""
+
+    def __init__(self, blob, chunk_size=STREAM_CHUNK_SIZE):
+        super(BlobReader, self).__init__()
+        self._chunk_size = chunk_size
+        if blob.size is None:
+            blob.reload()
+        self._blob = blob
+        self._size = blob.size
+        self._position = 0
+
+    @property
+    def name(self):
+        """Name of the blob being read"""
+        return self._blob.name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._size or not buffer:
+            return 0
+        end = min(self._position + min(len(buffer), self._chunk_size), self._size) - 1
+        data = self._blob.download_as_string(start=self._position, end=end)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+_END_OF_STREAM = object()
+_ABORT_STREAM = object()
+
+
+class _QueueReader(object):
+    """Readable end of the pipe between a BlobWriter and its upload thread.
+    The last chunk read is kept so the upload can rewind it to retry"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self._last = b''
+        self._position = 0
+        self._eof = False
+
+    def tell(self):
+        """Number of bytes read so far"""
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        """Rewind into the last chunk read, the only data still available"""
+        rewind = self._position - position
+        if whence != io.SEEK_SET or rewind < 0 or rewind > len(self._last):
+            raise IOError("Streaming upload can only rewind the last chunk")
+        if rewind:
+            self._buffer[0:0] = self._last[len(self._last) - rewind:]
+            self._last = self._last[:len(self._last) - rewind]
+            self._position = position
+        return self._position
+
+    def read(self, size=-1):
+        """Read up to size bytes, blocking until the writer produces them"""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._chunks.get()
+            if chunk is _ABORT_STREAM:
+                raise IOError("Streaming upload aborted")
+            if chunk is _END_OF_STREAM:
+                self._eof = True
+            else:
+                self._buffer.extend(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._last = data
+        self._position += len(data)
+        return data
+
+
+class BlobWriter(object):
+    """Writable file-like object streaming to a blob with a resumable upload.
+
+    Writes are grouped in chunks of `chunk_size` bytes handed to an upload
+    thread through a queue of at most `queue_size` chunks, so memory stays
+    bounded whatever the size of the data. With `compress` the data is gzipped
+    on the fly. Text is encoded with `encoding`. The blob is only created when
+    the writer is closed; leaving a `with` block with an exception aborts it"""
+
+    def __init__(self, blob, chunk_size=UPLOAD_CHUNK_SIZE, queue_size=2,
+                 compress=False, content_type=None, encoding="utf-8"):
+        if chunk_size % RESUMABLE_CHUNK_MULTIPLE:
+            raise ValueError("chunk_size must be a multiple of {}".format(
+                RESUMABLE_CHUNK_MULTIPLE))
+        blob.chunk_size = chunk_size
+        self.name = blob.name
+        self.closed = False
+        self._chunk_size = chunk_size
+        self._encoding = encoding
+        self._pending = bytearray()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        self._error = None
+        self._thread = threading.Thread(target=self._upload, args=(blob, content_type))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _upload(self, blob, content_type):
+        try:
+            blob.upload_from_file(_QueueReader(self._queue), content_type=content_type)
+        except Exception as error:  # pylint: disable=broad-except
+            self._error = error
+
+    def _put(self, chunk):
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def writable(self):
+        """Always True"""
+        return True
+
+    def write(self, data):
+        """Write bytes or text, blocking while the upload queue is full"""
+        if self.closed:
+            raise ValueError("I/O operation on closed writer")
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode(self._encoding)
+        size = len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._pending.extend(data)
+        while len(self._pending) >= self._chunk_size:
+            self._put(bytes(self._pending[:self._chunk_size]))
+            del self._pending[:self._chunk_size]
+        return size
+
+    def flush(self):
+        """Data is flushed in whole chunks, nothing to do"""
+
+    def close(self):
+        """Send the remaining data and wait for the upload to finish"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._compressor is not None:
+            self._pending.extend(self._compressor.flush())
+        if self._pending:
+            self._put(bytes(self._pending))
+        self._put(_END_OF_STREAM)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def abort(self):
+        """Cancel the upload, the blob is not created"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._put(_ABORT_STREAM)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
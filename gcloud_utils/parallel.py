@@ -0,0 +1,51 @@
+"""Module to run independent I/O bound tasks concurrently"""
+import time
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_WORKERS = 8
+
+
+class TaskResult(object):
+    """Outcome of one task executed by `run_parallel`"""
+
+    def __init__(self, item, value=None, error=None, elapsed=0.0):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        """True when the task finished without raising"""
+        return self.error is None
+
+
+def _run_task(func, item):
+    start = time.time()
+    try:
+        return TaskResult(item, value=func(item), elapsed=time.time() - start)
+    except Exception as error:  # pylint: disable=broad-except
+        return TaskResult(item, error=error, elapsed=time.time() - start)
+
+
+def run_parallel(func, items, workers=DEFAULT_WORKERS):
+    """Apply func to every item using a bounded thread pool.
+    Yields a TaskResult per item in completion order; errors are captured
+    in the result instead of being raised. `items` may be a lazy iterable,
+    it is consumed by the pool while the first tasks are already running"""
+    if isinstance(items, (list, tuple)):
+        if not items:
+            return
+        workers = min(workers, len(items))
+    if workers <= 1:
+        for item in items:
+            yield _run_task(func, item)
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(lambda item: _run_task(func, item), items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
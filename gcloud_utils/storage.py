@@ -1,126 +1,857 @@
 """Module to download and use files from Google Storage"""
+import io
 import os
+import csv
+import shutil
+import gzip
+import json
+import mmap
+import time
+import uuid
+import base64
+import fnmatch
+import hashlib
 import logging
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 from gcloud_utils.base_client import BaseClient
+from gcloud_utils.blob_streams import BlobReader, BlobWriter, STREAM_CHUNK_SIZE
+from gcloud_utils.parallel import DEFAULT_WORKERS, run_parallel
 
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_SIZE = 1024 * 1024
+SLICE_SIZE = 64 * 1024 * 1024
+PART_SIZE = 64 * 1024 * 1024
+MAX_COMPOSE_COMPONENTS = 32
+BATCH_SIZE = 100
+
+
+def _glob_prefix(pattern):
+    """Literal part of a glob pattern before its first wildcard"""
+    for index, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:index]
+    return pattern
+
+
+def _blob_filter(filter_suffix=None, pattern=None, min_size=None, max_size=None,
+                 updated_after=None, updated_before=None):
+    """Build a predicate over listed blobs, directory placeholders never match"""
+    def accept(blob):
+        size = blob.size or 0
+        return not blob.name.endswith("/") and all((
+            filter_suffix is None or blob.name.endswith(filter_suffix),
+            pattern is None or fnmatch.fnmatchcase(blob.name, pattern),
+            min_size is None or size >= min_size,
+            max_size is None or size <= max_size,
+            updated_after is None or blob.updated > updated_after,
+            updated_before is None or blob.updated < updated_before,
+        ))
+    return accept
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def _file_crc32c(path):
+    """CRC32C of a local file encoded as in blob metadata, None without google-crc32c"""
+    if google_crc32c is None:
+        return None
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('ascii')
+
+
+def _blob_matches_file(blob, path):
+    """Compare a blob with a local file using size and MD5, or CRC32C for
+    composite objects that carry no MD5"""
+    if blob.size is not None and blob.size != os.path.getsize(path):
+        return False
+    if blob.md5_hash:
+        return blob.md5_hash == _file_md5(path)
+    if blob.crc32c:
+        return blob.crc32c == _file_crc32c(path)
+    return False
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _delete_blob(blob):
+    """Delete a blob, ignoring blobs already deleted"""
+    try:
+        blob.delete()
+    except NotFound:
+        pass
+
+
+def _read_generation(path):
+    try:
+        with open(path) as generation_file:
+            return generation_file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _write_generation(path, generation):
+    temp_path = "{}.tmp-{}".format(path, uuid.uuid4().hex)
+    with open(temp_path, 'w') as generation_file:
+        generation_file.write(str(generation))
+    os.rename(temp_path, path)
 
-def _filter_suffix_files(blobs, suffix):
-    return [x for x in blobs if x.name.endswith(suffix)]
 
 def _prepare_path(path):
     if not os.path.exists(path):
         os.makedirs(path)
     return path
 
-class Storage(BaseClient):
+
+class TransferError(IOError):
+    """Raised when files of a multi-file transfer fail, `failed` maps the
+    name of each of them to its error"""
+
+    def __init__(self, message, failed):
+        super(TransferError, self).__init__(message)
+        self.failed = failed
+
+
+class TransferSummary(object):
+    """Result of a multi-file transfer with per-file errors and throughput"""
+
+    def __init__(self):
+        self.transferred = []
+        self.failed = {}
+        self.skipped = []
+        self.timings = {}
+        self.bytes = 0
+        self._start = time.time()
+        self.elapsed = 0.0
+
+    def add(self, name, size, elapsed):
+        """Register a file transferred successfully"""
+        self.transferred.append(name)
+        self.timings[name] = elapsed
+        self.bytes += size or 0
+
+    def finish(self):
+        """Stop the clock of the transfer"""
+        self.elapsed = time.time() - self._start
+        return self
+
+    @property
+    def files_per_second(self):
+        """Files transferred per second"""
+        return len(self.transferred) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_second(self):
+        """Megabytes transferred per second"""
+        return self.bytes / (1024.0 * 1024.0) / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return "<TransferSummary transferred={} failed={} skipped={} {:.2f} files/s {:.2f} MB/s>"\
+            .format(len(self.transferred), len(self.failed), len(self.skipped),
+                    self.files_per_second, self.mb_per_second)
+
+
+def _within_budget(blobs, max_bytes):
+    selected, skipped, total = [], [], 0
+    for blob in blobs:
+        size = blob.size or 0
+        if max_bytes is not None and total + size > max_bytes:
+            skipped.append(blob)
+        else:
+            selected.append(blob)
+            total += size
+    return selected, skipped
+
+
+class Storage(BaseClient):  # pylint: disable=too-many-public-methods
     """Google-Storage handler"""
 
     _MODEL_CLIENT = storage
 
-    def __init__(self, bucket, client=None, log_level=logging.ERROR):
+    def __init__(self, bucket, client=None, log_level=logging.ERROR, cache=None):
+        """`cache` is an optional BlobCache serving every download to a local
+        file: download_file, get_file, open_mmap, download_files,
+        get_files_in_path and sync. Cached blobs are copied whole, so
+        download_file does not slice blobs when a cache is set"""
         super(Storage, self).__init__(client, log_level)
         self._bucket = self._client.get_bucket(bucket)
+        self._cache = cache
 
-    def download_file(self, storage_path, local_path):
-        """Download Storage file to local path, creating a path at local_path if nedded"""
+    def download_file(self, storage_path, local_path, slice_threshold=None,
+                      slice_size=SLICE_SIZE, workers=DEFAULT_WORKERS):
+        """Download Storage file to local path, creating a path at local_path if nedded.
+        Files of at least `slice_threshold` bytes are split in byte ranges of
+        `slice_size` downloaded concurrently by `workers` threads straight
+        into their position of the local file, whose checksum is then verified.
+        With a cache the blob is copied from it instead, see `Storage`"""
+        if self._cache is not None:
+            return self._download_cached(storage_path, os.path.join(local_path, storage_path))
         obj = self._bucket.get_blob(storage_path)
-        local_file_full_path = os.path.join(local_path, obj.name)
+        if slice_threshold is not None and obj.size >= slice_threshold:
+            return self._download_blob_sliced(
+                obj, os.path.join(local_path, obj.name), slice_size, workers)
+        return self._download_blob(obj, local_path)
+
+    def _cached_path(self, storage_path, blob=None, store=False):
+        """Cached file of a blob, stored first on a miss or when `store` is set.
+        A listed `blob` spares the metadata request of revalidation"""
+        bucket_name = self._bucket.name
+        cached = None
+        if not self._cache.revalidate and not store:
+            cached = self._cache.path_for(bucket_name, storage_path)
+        if cached is None:
+            obj = blob if blob is not None and blob.generation is not None \
+                else self._bucket.get_blob(storage_path)
+            if not store:
+                cached = self._cache.path_for(bucket_name, storage_path, obj.generation)
+            if cached is None:
+                self.logger.debug("Cache miss for %s", storage_path)
+                cached = self._cache.store(
+                    bucket_name, storage_path, obj.generation, obj.download_to_file)
+        return cached
+
+    def _open_cached(self, storage_path, blob=None, attempts=3):
+        """Open the cached file of a blob. Another process may evict it
+        between the lookup and the open, so it is then stored again"""
+        for attempt in range(attempts):
+            try:
+                return open(self._cached_path(storage_path, blob, store=attempt > 0), 'rb')
+            except (IOError, OSError) as error:
+                self.logger.debug("Cached copy of %s evicted: %s", storage_path, error)
+                last_error = error
+        raise last_error
+
+    def _download_cached(self, storage_path, local_file_full_path, blob=None):
+        _prepare_path(os.path.dirname(local_file_full_path))
+        with self._open_cached(storage_path, blob) as cached, \
+                open(local_file_full_path, 'wb') as local_file:
+            shutil.copyfileobj(cached, local_file)
+        return local_file_full_path
+
+    def _download_once(self, storage_path, local_path):
+        """Download a blob unless the copy in local_path is of the same size
+        and generation, recorded in a .generation file next to it, writing
+        through a temporary file renamed into place"""
+        local_file_full_path = os.path.join(local_path, storage_path)
+        generation_path = local_file_full_path + ".generation"
+        obj = self._bucket.get_blob(storage_path)
+        if os.path.exists(local_file_full_path) and \
+                os.path.getsize(local_file_full_path) == obj.size:
+            if _read_generation(generation_path) == str(obj.generation):
+                return local_file_full_path
+            # Copies made without a generation file are checked once by checksum
+            if not os.path.exists(generation_path) and \
+                    _blob_matches_file(obj, local_file_full_path):
+                _write_generation(generation_path, obj.generation)
+                return local_file_full_path
+        temp_path = "{}.tmp-{}".format(local_file_full_path, uuid.uuid4().hex)
+        try:
+            self._download_blob_to(obj, temp_path)
+            os.rename(temp_path, local_file_full_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        _write_generation(generation_path, obj.generation)
+        return local_file_full_path
+
+    def open_mmap(self, storage_path, local_path, dtype=None):
+        """Return a read-only memory map of a Storage file, downloaded into
+        local_path only when there is no copy of the same generation there yet,
+        or into the BlobCache when the client has one. Processes mapping the
+        same file share its pages. With `dtype` a read-only NumPy array over the
+        map is returned. Empty files, which cannot be mapped, give empty bytes
+        or an empty array"""
+        if self._cache is not None:
+            local_file = self._open_cached(storage_path)
+        else:
+            local_file = open(self._download_once(storage_path, local_path), 'rb')
+        with local_file:
+            if os.fstat(local_file.fileno()).st_size == 0:
+                memory_map = b''
+            else:
+                memory_map = mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if dtype is None:
+            return memory_map
+        if numpy is None:
+            raise ImportError("numpy is required to open a memory map with a dtype")
+        return numpy.frombuffer(memory_map, dtype=dtype)
+
+    def _download_blob_sliced(self, blob, local_file_full_path, slice_size, workers):
+        _prepare_path(os.path.dirname(local_file_full_path))
+        with open(local_file_full_path, 'wb') as local_file:
+            local_file.truncate(blob.size)
+
+        def download_slice(start):
+            with open(local_file_full_path, 'r+b') as local_file:
+                local_file.seek(start)
+                blob.download_to_file(
+                    local_file, start=start, end=min(start + slice_size, blob.size) - 1)
+
+        slices = list(range(0, blob.size, slice_size))
+        self.logger.debug("Downloading %s in %s slices", blob.name, len(slices))
+        errors = [result.error for result in run_parallel(download_slice, slices, workers)
+                  if not result.ok]
+        if not errors and not self._verify_download(blob, local_file_full_path):
+            errors.append(IOError("Checksum mismatch downloading {}".format(blob.name)))
+        if errors:
+            os.remove(local_file_full_path)
+            raise errors[0]
+        return local_file_full_path
+
+    def _verify_download(self, blob, local_file_full_path):
+        if blob.crc32c and google_crc32c is not None:
+            return blob.crc32c == _file_crc32c(local_file_full_path)
+        if blob.md5_hash:
+            return blob.md5_hash == _file_md5(local_file_full_path)
+        self.logger.warning("Could not verify checksum of %s", blob.name)
+        return True
+
+    def _download_blob(self, blob, local_path):
+        return self._download_blob_to(blob, os.path.join(local_path, blob.name))
+
+    def _download_blob_to(self, blob, local_file_full_path):
+        if self._cache is not None:
+            return self._download_cached(blob.name, local_file_full_path, blob)
         _prepare_path(os.path.dirname(local_file_full_path))
         with open(local_file_full_path, 'wb') as local_file:
-            obj.download_to_file(local_file)
+            blob.download_to_file(local_file)
         return local_file_full_path
 
-    def download_files(self, path, local_path, filter_suffix=None):
-        """Download all files in path"""
+    def download_files(self, path, local_path, filter_suffix=None,
+                       workers=None, max_bytes=None, progress=None):
+        """Download all files in path.
+        When `workers` is given the files are fetched concurrently by that many
+        threads, at most `max_bytes` are downloaded in the run and a
+        TransferSummary is returned with per-file errors instead of aborting.
+        `progress` is called as progress(done, total, name) after each file."""
         list_paths = self.list_files(path, filter_suffix=filter_suffix)
-        for path_to_download in list_paths:
-            self.download_file(path_to_download.name, local_path)
+        if workers is None:
+            for path_to_download in list_paths:
+                self.download_file(path_to_download.name, local_path)
+            return None
+        return self._download_blobs(list_paths, lambda blob: local_path,
+                                    workers, max_bytes, progress)
+
+    def _download_blobs(self, blobs, local_path_for, workers=DEFAULT_WORKERS,
+                        max_bytes=None, progress=None):
+        summary = TransferSummary()
+        selected, skipped = _within_budget(blobs, max_bytes)
+        summary.skipped = [blob.name for blob in skipped]
+        if skipped:
+            self.logger.warning("Byte budget of %s reached, skipping %s files",
+                                max_bytes, len(skipped))
+
+        download = lambda blob: self._download_blob(blob, local_path_for(blob))
+        for done, result in enumerate(run_parallel(download, selected, workers), 1):
+            if result.ok:
+                summary.add(result.item.name, result.item.size, result.elapsed)
+            else:
+                self.logger.error("Error downloading %s: %s", result.item.name, result.error)
+                summary.failed[result.item.name] = result.error
+            if progress is not None:
+                progress(done, len(selected), result.item.name)
+        return summary.finish()
 
     def get_abs_path(self, storage_path):
         """get abs path from GStorage"""
         bucket_path = "gs://{}/".format(self._bucket.name)
         return os.path.join(bucket_path, storage_path)
 
-    def get_file(self, file_path, local_path):
-        """Get all files from Storage path"""
+    def get_file(self, file_path, local_path, stream=False):
+        """Get all files from Storage path.
+        With `stream` the file is read straight from Storage (see `open`)
+        and nothing is written to local_path"""
+        if stream:
+            return self.open(file_path)
         self.logger.debug("Download file...")
         full_path = self.download_file(file_path, local_path)
         return open(full_path)
 
-    def get_files_in_path(self, path, local_path):
-        """Download all files from path in Google Storage and return a list with those files"""
+    def open(self, storage_path, mode="r", chunk_size=STREAM_CHUNK_SIZE,
+             decompress=None, encoding="utf-8"):
+        """Open a Storage file for streaming reads without a local copy.
+        The blob is fetched in ranged chunks of `chunk_size` bytes while it is
+        consumed. `.gz` files, as exported by Bigquery.table_to_cloud_storage,
+        are decompressed on the fly unless `decompress` is False.
+        `mode` is "r" for text and "rb" for bytes."""
+        if mode not in ("r", "rb"):
+            raise ValueError("Only 'r' and 'rb' modes are supported, got {}".format(mode))
+        blob = self._bucket.get_blob(storage_path)
+        if blob is None:
+            raise IOError("File {} not found in bucket {}".format(
+                storage_path, self._bucket.name))
+
+        stream = io.BufferedReader(BlobReader(blob, chunk_size), buffer_size=chunk_size)
+        if decompress is None:
+            decompress = storage_path.endswith(".gz")
+        if decompress:
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        if mode == "r":
+            stream = io.TextIOWrapper(stream, encoding=encoding)
+        return stream
+
+    def iter_records(self, storage_path, record_format="json", **kwargs):
+        """Lazily yield the records of a Storage file: dicts for newline
+        delimited JSON and lists for CSV. Extra arguments go to `open`"""
+        with self.open(storage_path, **kwargs) as stream:
+            if record_format == "csv":
+                for row in csv.reader(stream):
+                    yield row
+            elif record_format == "json":
+                for line in stream:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                raise ValueError("Only csv and json records are supported")
+
+    def get_files_in_path(self, path, local_path, workers=None):
+        """Download all files from path in Google Storage and return a list with those files.
+        When `workers` is given the files are downloaded concurrently and a
+        TransferError with the failed files is raised once all are done"""
         files = self.list_files(path)
-        result = []
-        for file_blob in files:
-            result.append(self.get_file(file_blob.name,
-                                        "{}/{}".format(local_path, file_blob.name)))
-        return result
+        if workers is None:
+            result = []
+            for file_blob in files:
+                result.append(self.get_file(file_blob.name,
+                                            "{}/{}".format(local_path, file_blob.name)))
+            return result
+
+        local_path_for = lambda blob: "{}/{}".format(local_path, blob.name)
+        summary = self._download_blobs(files, local_path_for, workers)
+        if summary.failed:
+            raise TransferError("Failed to download files: {}".format(
+                ", ".join(sorted(summary.failed))), summary.failed)
+        return [open(os.path.join(local_path_for(blob), blob.name)) for blob in files]
 
-    def list_files(self, path, filter_suffix=None):
-        """List all blobs in path"""
-        blobs = self._bucket.list_blobs(prefix=path)
-        blobs_files = [x for x in blobs if not x.name.endswith("/")]
+    def iter_files(self, path, filter_suffix=None, pattern=None, min_size=None,
+                   max_size=None, updated_after=None, updated_before=None,
+                   fields=None, max_results=None, page_size=None):
+        """Lazily yield the blobs in path, page by page, keeping those that match
+        every given filter: name suffix, glob `pattern` over the full name,
+        size bounds in bytes and timezone-aware `updated` bounds.
+        The literal start of `pattern` narrows the listing prefix server-side.
+        `fields` is a comma separated list of blob properties to fetch, such as
+        "size,updated", and at most `max_results` blobs are yielded"""
+        prefix = path
+        if pattern is not None and _glob_prefix(pattern).startswith(path):
+            prefix = _glob_prefix(pattern)
 
-        if filter_suffix is not None:
-            return _filter_suffix_files(blobs_files, filter_suffix)
-        return blobs_files
+        kwargs = {"prefix": prefix}
+        if fields is not None:
+            properties = set(field.strip() for field in fields.split(","))
+            properties.add("name")
+            if min_size is not None or max_size is not None:
+                properties.add("size")
+            if updated_after is not None or updated_before is not None:
+                properties.add("updated")
+            kwargs["fields"] = "items({}),nextPageToken".format(",".join(sorted(properties)))
+
+        accept = _blob_filter(filter_suffix, pattern, min_size, max_size,
+                              updated_after, updated_before)
+        if page_size is None:
+            blobs = self._bucket.list_blobs(**kwargs)
+        else:
+            blobs = (blob for page in self._iter_pages(page_size, **kwargs) for blob in page)
+
+        if max_results is not None and max_results <= 0:
+            return
+        found = 0
+        for blob in blobs:
+            if accept(blob):
+                yield blob
+                found += 1
+                if max_results is not None and found >= max_results:
+                    return
+
+    def list_files(self, path, filter_suffix=None, **filters):
+        """List all blobs in path. Accepts the same filters as `iter_files`"""
+        return list(self.iter_files(path, filter_suffix=filter_suffix, **filters))
 
     def path_exists_storage(self, path):
         """Check if path exists on Storage"""
         return self._bucket.blob(path).exists()
 
-    def upload_file(self, storage_path, local_path):
-        """Upload one local file to Storage"""
-        with open(local_path) as loc:
+    def stat_many(self, paths, workers=DEFAULT_WORKERS, from_listing=False):
+        """Return a dict mapping each path to its blob with metadata, or None
+        when it does not exist. Paths are fetched concurrently by `workers`
+        threads or, with `from_listing`, answered from a single listing of
+        their common prefix, cheaper when they are many files of one directory"""
+        paths = list(paths)
+        result = dict((path, None) for path in paths)
+        if not paths:
+            return result
+        if from_listing:
+            missing = set(paths)
+            # Listed without filters, so directory placeholders are found as
+            # they are by get_blob
+            for blob in self._bucket.list_blobs(prefix=os.path.commonprefix(paths)):
+                if blob.name in missing:
+                    result[blob.name] = blob
+                    missing.discard(blob.name)
+                    if not missing:
+                        break
+            return result
+
+        for task in run_parallel(self._bucket.get_blob, paths, workers):
+            if not task.ok:
+                raise task.error
+            result[task.item] = task.value
+        return result
+
+    def exists_many(self, paths, workers=DEFAULT_WORKERS, from_listing=False):
+        """Return a dict mapping each path to whether it exists on Storage,
+        see `stat_many`"""
+        return dict((path, blob is not None) for path, blob in
+                    self.stat_many(paths, workers, from_listing).items())
+
+    def upload_file(self, storage_path, local_path, composite_threshold=None,
+                    part_size=PART_SIZE, workers=DEFAULT_WORKERS):
+        """Upload one local file to Storage.
+        Files of at least `composite_threshold` bytes are split in parts of
+        `part_size` uploaded concurrently by `workers` threads as temporary
+        objects and composed server-side into storage_path"""
+        if composite_threshold is not None and os.path.getsize(local_path) >= composite_threshold:
+            self._upload_composite(storage_path, local_path, part_size, workers)
+            return
+        with open(local_path, 'rb') as loc:
             self.logger.debug("Upload file %s to %s", local_path, storage_path)
             self._bucket.blob(storage_path).upload_from_file(loc)
 
-    def upload_path(self, storage_path_base, local_path_base):
-        """Upload all filer from local path to Storage"""
+    def _upload_part(self, part_name, local_path, start, size):
+        with open(local_path, 'rb') as loc:
+            loc.seek(start)
+            self._bucket.blob(part_name).upload_from_file(loc, size=size)
+        return self._bucket.blob(part_name)
+
+    def _compose(self, storage_path, blobs, temporary, parts_prefix):
+        """Compose blobs into storage_path, through intermediate objects when
+        there are more than the components allowed in one compose request"""
+        level = 0
+        while len(blobs) > MAX_COMPOSE_COMPONENTS:
+            groups = [blobs[i:i + MAX_COMPOSE_COMPONENTS]
+                      for i in range(0, len(blobs), MAX_COMPOSE_COMPONENTS)]
+            blobs = []
+            for index, group in enumerate(groups):
+                intermediate = self._bucket.blob("{}/c{}_{}".format(parts_prefix, level, index))
+                temporary.append(intermediate)
+                intermediate.compose(group)
+                blobs.append(intermediate)
+            level += 1
+        self._bucket.blob(storage_path).compose(blobs)
+
+    def _upload_composite(self, storage_path, local_path, part_size, workers):
+        file_size = os.path.getsize(local_path)
+        parts_prefix = "{}.parts-{}".format(storage_path, uuid.uuid4().hex)
+        starts = list(range(0, file_size, part_size))
+        self.logger.debug("Upload file %s to %s in %s parts", local_path, storage_path, len(starts))
+
+        upload_part = lambda start: self._upload_part(
+            "{}/{:06d}".format(parts_prefix, start // part_size), local_path,
+            start, min(part_size, file_size - start))
+        results = list(run_parallel(upload_part, starts, workers))
+        temporary = [result.value for result in results if result.ok]
+        try:
+            errors = [result.error for result in results if not result.ok]
+            if errors:
+                raise errors[0]
+            parts = sorted(temporary, key=lambda blob: blob.name)
+            self._compose(storage_path, parts, temporary, parts_prefix)
+        finally:
+            for blob in temporary:
+                try:
+                    blob.delete()
+                except Exception as error:  # pylint: disable=broad-except
+                    self.logger.warning("Could not delete temporary part %s: %s",
+                                        blob.name, error)
+
+    def _walk_uploads(self, storage_path_base, local_path_base, preserve_structure, skipped):
+        seen = set()
         for root, _, files in os.walk(local_path_base):
             for file_to_upload in files:
                 full_path_upload = os.path.join(root, file_to_upload)
-                storage_path = os.path.join(storage_path_base, file_to_upload)
+                if preserve_structure:
+                    relative_path = os.path.relpath(full_path_upload, local_path_base)
+                    storage_path = os.path.join(
+                        storage_path_base, relative_path.replace(os.sep, "/"))
+                else:
+                    storage_path = os.path.join(storage_path_base, file_to_upload)
+                if storage_path in seen:
+                    self.logger.warning("Skipping %s, %s was already uploaded from another path",
+                                        full_path_upload, storage_path)
+                    skipped.append(full_path_upload)
+                    continue
+                seen.add(storage_path)
+                yield storage_path, full_path_upload
+
+    def upload_path(self, storage_path_base, local_path_base, workers=None,
+                    preserve_structure=False, progress=None):
+        """Upload all filer from local path to Storage.
+        Files are uploaded flat under storage_path_base unless `preserve_structure`
+        is set, in which case the relative directory structure is kept.
+        When `workers` is given the directory is walked while files are uploaded
+        concurrently and a TransferSummary with per-file timings is returned.
+        `progress` is called as progress(done, local_path) after each file."""
+        skipped = []
+        uploads = self._walk_uploads(
+            storage_path_base, local_path_base, preserve_structure, skipped)
+        if workers is None:
+            for storage_path, full_path_upload in uploads:
                 self.upload_file(storage_path, full_path_upload)
+            return None
+
+        summary = TransferSummary()
+        upload = lambda paths: self.upload_file(*paths)
+        for done, result in enumerate(run_parallel(upload, uploads, workers), 1):
+            storage_path, full_path_upload = result.item
+            if result.ok:
+                summary.add(storage_path, os.path.getsize(full_path_upload), result.elapsed)
+            else:
+                self.logger.error("Error uploading %s: %s", full_path_upload, result.error)
+                summary.failed[storage_path] = result.error
+            if progress is not None:
+                progress(done, full_path_upload)
+        summary.skipped = skipped
+        return summary.finish()
+
+    def _sync_plan(self, local_path, storage_prefix, direction, delete):
+        prefix = storage_prefix.rstrip("/") + "/" if storage_prefix else ""
+        remote = dict((blob.name[len(prefix):], blob) for blob in self.list_files(prefix))
+        local = {}
+        for root, _, files in os.walk(local_path):
+            for local_file in files:
+                full_path = os.path.join(root, local_file)
+                relative_path = os.path.relpath(full_path, local_path).replace(os.sep, "/")
+                local[relative_path] = full_path
+
+        plan = {"transfer": [], "delete": [], "unchanged": []}
+        sources, targets = (local, remote) if direction == "upload" else (remote, local)
+        for name in sorted(sources):
+            if name in remote and name in local and _blob_matches_file(remote[name], local[name]):
+                plan["unchanged"].append(name)
+            else:
+                plan["transfer"].append(name)
+        if delete:
+            plan["delete"] = sorted(set(targets) - set(sources))
+        return plan, prefix, local, remote
+
+    def sync(self, local_path, storage_prefix, direction="upload", delete=False,
+             dry_run=False, workers=DEFAULT_WORKERS):
+        """Synchronize a local directory with a Storage prefix transferring only
+        the files whose size and checksum differ.
+        `direction` is "upload" (local to Storage) or "download" (Storage to local),
+        `delete` removes files missing from the source side and `dry_run` only
+        returns the plan: a dict with the relative names to "transfer", "delete"
+        and the "unchanged" ones. When executed, the plan also holds the
+        TransferSummary of the run under "summary"."""
+        if direction not in ("upload", "download"):
+            raise ValueError("direction must be 'upload' or 'download', got {}".format(direction))
+
+        plan, prefix, local, remote = self._sync_plan(local_path, storage_prefix, direction, delete)
+        if dry_run:
+            return plan
+
+        if direction == "upload":
+            transfer = lambda name: self.upload_file(prefix + name, local[name])
+            remove = lambda name: remote[name].delete()
+        else:
+            transfer = lambda name: self._download_blob_to(
+                remote[name], os.path.join(local_path, name))
+            remove = lambda name: os.remove(local[name])
+
+        summary = TransferSummary()
+        for result in run_parallel(transfer, plan["transfer"], workers):
+            if result.ok:
+                size = os.path.getsize(local[result.item]) if direction == "upload" \
+                    else remote[result.item].size
+                summary.add(result.item, size, result.elapsed)
+            else:
+                self.logger.error("Error syncing %s: %s", result.item, result.error)
+                summary.failed[result.item] = result.error
+        for result in run_parallel(remove, plan["delete"], workers):
+            if not result.ok:
+                self.logger.error("Error deleting %s: %s", result.item, result.error)
+                summary.failed[result.item] = result.error
+        plan["summary"] = summary.finish()
+        return plan
 
     def upload_value(self, storage_path, value):
         """Upload a value to  Storage"""
         self._bucket.blob(storage_path).upload_from_string(value)
 
+    def open_writer(self, storage_path, **kwargs):
+        """Return a BlobWriter streaming to storage_path with a resumable upload,
+        see BlobWriter for the arguments"""
+        return BlobWriter(self._bucket.blob(storage_path), **kwargs)
+
+    def upload_stream(self, storage_path, chunks, **kwargs):
+        """Upload the bytes or text chunks produced by an iterable or generator
+        with bounded memory. Extra arguments go to `open_writer`"""
+        with self.open_writer(storage_path, **kwargs) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
     def delete_file(self, storage_path):
         """Deletes a blob from the bucket."""
         self._bucket.blob(storage_path).delete()
 
-    def delete_path(self, storage_path):
-        """Deletes all the blobs with storage_path prefix"""
+    def _run_batched(self, operation, blobs, workers):
+        """Run operation(blob) for every blob grouping the requests in batches
+        of BATCH_SIZE, with `workers` batches in flight. A failed batch is
+        retried one request at a time to find out which blobs failed"""
+        def run_batch(batch_blobs):
+            try:
+                with self._client.batch():
+                    for blob in batch_blobs:
+                        operation(blob)
+                return batch_blobs, {}
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.warning("Batch of %s requests failed (%s), retrying one by one",
+                                    len(batch_blobs), error)
+            succeeded, failed = [], {}
+            for blob in batch_blobs:
+                try:
+                    operation(blob)
+                    succeeded.append(blob)
+                except Exception as error:  # pylint: disable=broad-except
+                    failed[blob.name] = error
+            return succeeded, failed
+
+        succeeded, failed = [], {}
+        for result in run_parallel(run_batch, _chunks(list(blobs), BATCH_SIZE), workers):
+            if result.ok:
+                succeeded.extend(result.value[0])
+                failed.update(result.value[1])
+            else:
+                failed.update((blob.name, result.error) for blob in result.item)
+        return succeeded, failed
+
+    def delete_path(self, storage_path, workers=1):
+        """Deletes all the blobs with storage_path prefix.
+        Deletes are sent in batch requests, `workers` batches at a time.
+        Returns a dict with the "succeeded" names and the "failed" ones mapped to their error"""
         blobs = self.list_files(storage_path)
+        succeeded, failed = self._run_batched(_delete_blob, blobs, workers)
+        self.logger.info("%s blobs deleted from %s, %s failed",
+                         len(succeeded), storage_path, len(failed))
+        return {"succeeded": [blob.name for blob in succeeded], "failed": failed}
 
-        for blob in blobs:
-            blob.delete()
-            self.logger.info("Blob %s deleted", blob.name)
+    def rename_files(self, storage_prefix, new_path, workers=1):
+        """Renames all the blobs with storage_prefix prefix.
+        Blobs are copied and then the originals deleted using batch requests,
+        `workers` batches at a time. Returns a dict with the "succeeded" names
+        and the "failed" ones mapped to their error"""
+        blobs = self.list_files(storage_prefix)
+        new_names = dict((blob.name, new_path + blob.name.replace(storage_prefix, ""))
+                         for blob in blobs)
+
+        copy = lambda blob: self._bucket.copy_blob(blob, self._bucket, new_names[blob.name])
+        copied, failed = self._run_batched(copy, blobs, workers)
+        renamed, failed_delete = self._run_batched(_delete_blob, copied, workers)
+        failed.update(failed_delete)
+        self.logger.info("%s blobs renamed from %s to %s, %s failed",
+                         len(renamed), storage_prefix, new_path, len(failed))
+        return {"succeeded": [blob.name for blob in renamed], "failed": failed}
+
+    def _destination_bucket(self, destination_bucket):
+        if destination_bucket is None:
+            return self._bucket
+        return self._client.bucket(destination_bucket)
+
+    def _rewrite(self, source_blob, destination_blob, progress=None):
+        token, rewritten, total = destination_blob.rewrite(source_blob)
+        while token is not None:
+            if progress is not None:
+                progress(rewritten, total)
+            token, rewritten, total = destination_blob.rewrite(source_blob, token=token)
+        if progress is not None:
+            progress(rewritten, total)
+        return total
 
-    def rename_files(self, storage_prefix, new_path):
-        """Renames all the blobs with storage_prefix prefix"""
+    def copy_file(self, storage_path, new_storage_path, destination_bucket=None, progress=None):
+        """Copy a blob server-side, to another bucket when `destination_bucket`
+        is given, without passing the data through this machine.
+        Large copies are resumed with rewrite tokens, calling
+        progress(bytes_rewritten, total_bytes) after each round. Returns the size copied"""
+        source_blob = self._bucket.blob(storage_path)
+        destination_blob = self._destination_bucket(destination_bucket).blob(new_storage_path)
+        return self._rewrite(source_blob, destination_blob, progress)
+
+    def copy_path(self, storage_prefix, new_prefix, destination_bucket=None,
+                  workers=DEFAULT_WORKERS, progress=None):
+        """Copy server-side all the blobs with storage_prefix prefix replacing
+        it with new_prefix, to another bucket when `destination_bucket` is
+        given. `workers` blobs are copied concurrently and progress(done,
+        total, name) is called after each one. Returns a TransferSummary"""
         blobs = self.list_files(storage_prefix)
+        bucket = self._destination_bucket(destination_bucket)
+        copy = lambda blob: self._rewrite(
+            blob, bucket.blob(new_prefix + blob.name[len(storage_prefix):]))
 
-        for blob in blobs:
-            new_name = blob.name.replace(storage_prefix, "")
-            new_full_name = new_path + new_name
-            self._bucket.rename_blob(blob, new_full_name)
-            self.logger.info("Blob %s renamed to %s", blob.name, new_full_name)
+        summary = TransferSummary()
+        for done, result in enumerate(run_parallel(copy, blobs, workers), 1):
+            if result.ok:
+                summary.add(result.item.name, result.value, result.elapsed)
+            else:
+                self.logger.error("Error copying %s: %s", result.item.name, result.error)
+                summary.failed[result.item.name] = result.error
+            if progress is not None:
+                progress(done, len(blobs), result.item.name)
+        return summary.finish()
+
+    def _iter_pages(self, page_size=None, **kwargs):
+        """Yield the pages of a blob listing, requesting `page_size` blobs per
+        page and following the page tokens, or the API default when None"""
+        if page_size is None:
+            for page in self._bucket.list_blobs(**kwargs).pages:
+                yield page
+            return
+        page_token = None
+        while True:
+            iterator = self._bucket.list_blobs(
+                max_results=page_size, page_token=page_token, **kwargs)
+            for page in iterator.pages:
+                yield page
+            page_token = iterator.next_page_token
+            if not page_token:
+                return
+
+    def iter_ls(self, path, page_size=None):
+        """Lazily yield the names of files and directories directly under path,
+        fetching one page of a delimiter listing at a time"""
+        prefix = path if not path or path.endswith("/") else path + "/"
+        seen_prefixes = set()
+        for page in self._iter_pages(page_size, prefix=prefix, delimiter="/"):
+            items = [blob.name[len(prefix):] for blob in page]
+            for directory in page.prefixes:
+                if directory not in seen_prefixes:
+                    seen_prefixes.add(directory)
+                    items.append(directory[len(prefix):].rstrip("/"))
+            for item in sorted(items):
+                if item:
+                    yield item
 
     def ls(self, path):
         """List files directly under specified path"""
-        blobs = self._bucket.list_blobs(prefix=path)
-        items = []
-        for blob in blobs:
-            relative_path = blob.name.replace(path, "")
-            if relative_path.startswith("/"):
-                relative_path = relative_path.replace("/", "", 1)
-            item = relative_path.split('/')[0]
-            if item not in items:
-                items.append(item)
+        items = sorted(set(self.iter_ls(path)))
         self.logger.info(items)
 
         return items
@@ -1,12 +1,14 @@
 """Test Bigquery Module"""
 import unittest
 import os
+from gcloud_utils.bigquery import columnar
 from gcloud_utils.bigquery.bigquery import Bigquery
 from gcloud_utils.bigquery.query_builder import QueryBuilder
 from google.cloud import bigquery
+from google.cloud.bigquery.table import RowIterator
 from mock.mock import MagicMock, patch, call
 from more_itertools.more import side_effect
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import NotFound, TooManyRequests
 
 try:
     import mock
@@ -297,3 +299,275 @@ class TestBigquery(unittest.TestCase):
             assert not bigquery.table_exists(table_id="my_table", dataset_id="my_dataset", project_id="my_project")
             assert original_bigquery.Client.call_args_list == [call("my_project")]
             assert other_client.dataset.call_args_list == [call("my_dataset")]
+
+    def test_query_iter_streams_pages(self):
+        schema = [bigquery.SchemaField("id", "INTEGER"), bigquery.SchemaField("name", "STRING"),
+                  bigquery.SchemaField("value", "FLOAT")]
+        responses = [
+            {"rows": [{"f": [{"v": "a"}, {"v": "1"}]}, {"f": [{"v": "b"}, {"v": "2"}]}],
+             "pageToken": "next"},
+            {"rows": [{"f": [{"v": "c"}, {"v": "3"}]}]}]
+        api_request = mock.Mock(side_effect=responses)
+
+        def list_rows(table, selected_fields, page_size, max_results):
+            return RowIterator(client_mock, api_request, "/path", selected_fields,
+                               page_size=page_size, max_results=max_results)
+
+        job_mock = mock.Mock(**{"result.return_value": mock.Mock(schema=schema)})
+        client_mock = mock.Mock(**{"query.return_value": job_mock, "list_rows.side_effect": list_rows})
+        bq = Bigquery(client_mock)
+
+        rows = bq.query_iter("select * from test", page_size=2, columns=["name", "id"])
+        self.assertEqual(("a", 1), next(rows))
+        self.assertEqual(1, api_request.call_count)
+        self.assertEqual([("b", 2), ("c", 3)], list(rows))
+        client_mock.list_rows.assert_called_once_with(
+            job_mock.destination, selected_fields=[schema[1], schema[0]],
+            page_size=2, max_results=None)
+
+        api_request.side_effect = [{"rows": [{"f": [{"v": "1"}]}]}]
+        rows = bq.query_iter("select * from test", max_rows=10, row_format="dict", columns=["id"])
+        self.assertEqual({"id": 1}, next(rows))
+
+    @unittest.skipIf(columnar.numpy is None or columnar.pyarrow is None, "needs numpy and pyarrow")
+    def test_query_row_format_is_checked_on_call(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+
+        with self.assertRaises(ValueError):
+            bq.query_iter("select 1", row_format="bogus")
+        client_mock.query.assert_not_called()
+
+    def test_query_batch_format_is_checked_on_call(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+
+        with self.assertRaises(ValueError):
+            bq.query_batches("select 1", batch_format="bogus")
+        with self.assertRaises(ValueError):
+            bq.query_columns("select 1", batch_format="bogus")
+        client_mock.query.assert_not_called()
+
+    def test_query_batches_columnar(self):
+        schema = [bigquery.SchemaField("id", "INTEGER"), bigquery.SchemaField("score", "FLOAT"),
+                  bigquery.SchemaField("active", "BOOLEAN"), bigquery.SchemaField("day", "DATE"),
+                  bigquery.SchemaField("at", "TIMESTAMP"), bigquery.SchemaField("name", "STRING")]
+        responses = [
+            {"rows": [{"f": [{"v": "1"}, {"v": "0.5"}, {"v": "true"}, {"v": "2018-10-11"},
+                             {"v": "1.5391872E9"}, {"v": "a"}]},
+                      {"f": [{"v": "2"}, {"v": None}, {"v": "false"}, {"v": None},
+                             {"v": None}, {"v": None}]}],
+             "pageToken": "next"},
+            {"rows": [{"f": [{"v": None}, {"v": "1"}, {"v": "true"}, {"v": "2018-10-12"},
+                             {"v": "0"}, {"v": "c"}]}]}]
+        api_request = mock.Mock(side_effect=list(responses))
+
+        def list_rows(table, selected_fields, page_size, max_results):
+            return RowIterator(client_mock, api_request, "/path", selected_fields,
+                               page_size=page_size, max_results=max_results)
+
+        job_mock = mock.Mock(**{"result.return_value": mock.Mock(schema=schema)})
+        client_mock = mock.Mock(**{"query.return_value": job_mock, "list_rows.side_effect": list_rows})
+        bq = Bigquery(client_mock)
+
+        batches = bq.query_batches(QueryBuilder("select * from test"), batch_format="numpy")
+        first = next(batches)
+        self.assertEqual(1, api_request.call_count)
+        self.assertEqual("int64", first["id"].dtype)
+        self.assertEqual([True, False], list(first["active"]))
+        self.assertEqual("2018-10-11", str(first["day"][0]))
+        self.assertEqual("2018-10-10T16:00:00.000000", str(first["at"][0]))
+        self.assertEqual(1, len(list(batches)))
+
+        api_request.side_effect = list(responses)
+        table = bq.query_columns("select * from test")
+        self.assertEqual(3, table.num_rows)
+        self.assertEqual([1, 2, None], table.column("id").to_pylist())
+        self.assertEqual([0.5, None, 1.0], table.column("score").to_pylist())
+        self.assertEqual(["a", None, "c"], table.column("name").to_pylist())
+
+    def test_columnar_repeated_and_record_fields(self):
+        schema = [bigquery.SchemaField("tags", "STRING", mode="REPEATED"),
+                  bigquery.SchemaField("point", "RECORD", fields=[
+                      bigquery.SchemaField("x", "INTEGER")])]
+        pages = [
+            [{"f": [{"v": [{"v": "a"}, {"v": "b"}]}, {"v": {"f": [{"v": "1"}]}}]},
+             {"f": [{"v": [{"v": "c"}, {"v": "d"}]}, {"v": None}]}],
+            [{"f": [{"v": []}, {"v": {"f": [{"v": "2"}]}}]}]]
+
+        columns = [columnar.decode_page(page, schema) for page in pages]
+        self.assertEqual((2,), columns[0]["tags"].shape)
+        self.assertEqual(["a", "b"], columns[0]["tags"][0])
+        self.assertEqual({"x": 1}, columns[0]["point"][0])
+
+        for batch_format in ("arrow", "pandas", "numpy"):
+            batches = [columnar.to_format(page, schema, batch_format) for page in columns]
+            result = columnar.concat(batches, schema, batch_format)
+            self.assertEqual(3, len(result["tags"]))
+        table = columnar.concat([columnar.to_format(page, schema, "arrow") for page in columns],
+                                schema, "arrow")
+        self.assertEqual([["a", "b"], ["c", "d"], []], table.column("tags").to_pylist())
+        self.assertEqual([{"x": 1}, None, {"x": 2}], table.column("point").to_pylist())
+
+    def test_query_async_does_not_wait(self):
+        job_mock = mock.Mock()
+        client_mock = mock.Mock(**{"query.return_value": job_mock})
+        bq = Bigquery(client_mock)
+
+        self.assertEqual(job_mock, bq.query_to_table_async("select 1", "dataset", "table"))
+        job_mock.result.assert_not_called()
+        self.assertEqual(client_mock.extract_table.return_value,
+                         bq.table_to_cloud_storage_async("dataset", "table", "bucket", "file"))
+        client_mock.extract_table.return_value.result.assert_not_called()
+
+    def test_query_dry_run(self):
+        job_mock = mock.Mock(total_bytes_processed=2048,
+                             referenced_tables=[bigquery.TableReference.from_string("p.d.t")])
+        client_mock = mock.Mock(**{"query.return_value": job_mock})
+        bq = Bigquery(client_mock, max_bytes_billed=1024)
+
+        estimate = bq.query_to_table("select * from d.t", "dataset", "table", dry_run=True)
+
+        self.assertEqual({"total_bytes_processed": 2048, "referenced_tables": ["p.d.t"],
+                          "within_max_bytes_billed": False}, estimate)
+        job_config = client_mock.query.call_args[1]["job_config"]
+        self.assertTrue(job_config.dry_run)
+        self.assertFalse(job_config.use_query_cache)
+        self.assertEqual(1024, job_config.maximum_bytes_billed)
+        job_mock.result.assert_not_called()
+
+    def test_max_bytes_billed_and_accounting(self):
+        job_mock = mock.Mock(total_bytes_processed=100, total_bytes_billed=10485760,
+                             slot_millis=30)
+        client_mock = mock.Mock(**{"query.return_value": job_mock})
+        bq = Bigquery(client_mock, max_bytes_billed=10 ** 9)
+        bq.accounting.reset()
+
+        bq.query("select 1")
+        bq.query_to_table("select 1", "dataset", "table", job_config=bigquery.QueryJobConfig(
+            maximum_bytes_billed=5))
+
+        self.assertEqual(10 ** 9, client_mock.query.call_args_list[0][1]["job_config"].maximum_bytes_billed)
+        self.assertEqual(5, client_mock.query.call_args_list[1][1]["job_config"].maximum_bytes_billed)
+        self.assertEqual({"jobs": 2, "total_bytes_processed": 200,
+                          "total_bytes_billed": 20971520, "slot_millis": 60},
+                         bq.accounting.snapshot())
+
+    def test_max_bytes_billed_caps_higher_job_limits(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock, max_bytes_billed=1024)
+
+        bq.query_async("select 1", job_config=bigquery.QueryJobConfig(
+            maximum_bytes_billed=10 ** 12))
+
+        self.assertEqual(1024, client_mock.query.call_args[1]["job_config"].maximum_bytes_billed)
+
+    def test_backfill_retries_submission_errors(self):
+        job = mock.Mock(**{"state": "DONE", "error_result": None})
+        client_mock = mock.Mock(**{"query.side_effect": [
+            TooManyRequests("rate limited"), job, job]})
+        bq = Bigquery(client_mock)
+
+        summary = bq.backfill("select 1", "dataset", "table_{date}", "20180101", "20180102",
+                              retries=1, poll_interval=0)
+
+        self.assertEqual(["20180101", "20180102"], summary["succeeded"])
+        self.assertEqual({}, summary["failed"])
+        self.assertEqual({"20180101": 2, "20180102": 1}, summary["attempts"])
+
+    def test_backfill_needs_a_table_per_day(self):
+        with self.assertRaises(ValueError):
+            Bigquery(mock.Mock()).backfill("select 1", "dataset", "table", "20180101", "20180102")
+
+    def test_backfill_retries_failed_days(self):
+        def job(error=None):
+            return mock.Mock(**{"state": "DONE", "error_result": error,
+                                "exception.return_value": ValueError(error)})
+        client_mock = mock.Mock(**{"query.side_effect": [
+            job(), job("boom"), job(), job("boom"), job("boom")]})
+        bq = Bigquery(client_mock)
+
+        summary = bq.backfill("select '${start_date}' from t where d < ${next_date}",
+                              "dataset", "table", "20180227", "20180301",
+                              query_args={"start_date": "ignored"}, max_concurrent=2,
+                              retries=2, partitioned=True, poll_interval=0)
+
+        self.assertEqual(["20180227", "20180301"], summary["succeeded"])
+        self.assertEqual(["20180228"], list(summary["failed"]))
+        self.assertEqual({"20180227": 1, "20180228": 3, "20180301": 1}, summary["attempts"])
+        queries = [kwargs["query"] for _, kwargs in client_mock.query.call_args_list]
+        self.assertEqual("select '20180227' from t where d < 20180228", queries[0])
+        client_mock.dataset.return_value.table.assert_any_call("table$20180228")
+
+    def test_import_uris_to_partition(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+
+        jobs = bq.cloud_storage_to_table("bucket", ["day/*.json", "gs://other/file.json"],
+                                         "dataset", "table$20180101", import_format="json")
+
+        self.assertEqual([client_mock.load_table_from_uri.return_value], jobs)
+
+        client_mock.dataset.return_value.table.assert_any_call("table")
+        client_mock.dataset.return_value.table.assert_called_with("table$20180101")
+        args, kwargs = client_mock.load_table_from_uri.call_args
+        self.assertEqual(["gs://bucket/day/*.json", "gs://other/file.json"], args[0])
+        self.assertEqual("NEWLINE_DELIMITED_JSON", kwargs["job_config"].source_format)
+
+    def test_import_to_partition_creates_partitioned_table(self):
+        client_mock = mock.Mock()
+        client_mock.dataset.return_value.table.side_effect = bigquery.DatasetReference(
+            "project", "dataset").table
+        bq = Bigquery(client_mock)
+
+        bq.cloud_storage_to_table("bucket", "file.json", "dataset", "table",
+                                  import_format="json", partition="20180101")
+
+        table = client_mock.create_table.call_args[0][0]
+        self.assertEqual("table", table.table_id)
+        self.assertEqual("DAY", table.time_partitioning.type_)
+        self.assertEqual("table$20180101", client_mock.load_table_from_uri.call_args[0][1].table_id)
+
+    def test_import_to_partition_keeps_job_partitioning(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+        job_config = bigquery.LoadJobConfig()
+        job_config.time_partitioning = bigquery.TimePartitioning(field="day")
+
+        bq.cloud_storage_to_table("bucket", "file.json", "dataset", "table$20180101",
+                                  job_config, import_format="json")
+
+        table = client_mock.create_table.call_args[0][0]
+        self.assertEqual("day", table.time_partitioning.field)
+
+    def test_import_chunks_many_uris(self):
+        jobs = [mock.Mock(**{"state": "DONE", "error_result": None})
+                for _ in range(3)]
+        client_mock = mock.Mock(**{"load_table_from_uri.side_effect": jobs})
+        bq = Bigquery(client_mock)
+        job_config = bigquery.LoadJobConfig()
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+
+        result = bq.cloud_storage_to_table("bucket", ["f{}".format(i) for i in range(5)],
+                                           "dataset", "table", job_config,
+                                           partition="20180101", uris_per_job=2)
+
+        self.assertEqual(jobs, result)
+        calls = client_mock.load_table_from_uri.call_args_list
+        self.assertEqual([["gs://bucket/f0", "gs://bucket/f1"],
+                          ["gs://bucket/f2", "gs://bucket/f3"], "gs://bucket/f4"],
+                         [args[0] for args, _ in calls])
+        self.assertEqual(["WRITE_TRUNCATE", "WRITE_APPEND", "WRITE_APPEND"],
+                         [kwargs["job_config"].write_disposition for _, kwargs in calls])
+        jobs[0].result.assert_called_once()
+
+    def test_query_sends_rendered_parameters(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+
+        bq.query(QueryBuilder("select * from t where d = '${day}'").render(
+            params=("day",), day="20180101"))
+
+        kwargs = client_mock.query.call_args[1]
+        self.assertEqual("select * from t where d = @day", kwargs["query"])
+        self.assertEqual("20180101", kwargs["job_config"].query_parameters[0].value)
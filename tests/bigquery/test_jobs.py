@@ -0,0 +1,76 @@
+"""Test jobs Module"""
+import unittest
+from gcloud_utils.bigquery.accounting import ACCOUNTING
+from gcloud_utils.bigquery.jobs import FailedSubmission, JobTimeout, as_completed, wait_all
+
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+
+def make_job(polls_until_done, error_result=None):
+    job = mock.Mock(error_result=error_result, state="RUNNING")
+    states = iter(["RUNNING"] * polls_until_done + ["DONE"])
+
+    def reload():
+        job.state = next(states)
+    job.reload.side_effect = reload
+    return job
+
+
+class TestJobs(unittest.TestCase):
+    "Test jobs module"
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    def test_as_completed_yields_in_completion_order(self, sleep_mock):
+        slow, fast = make_job(2), make_job(0)
+        self.assertEqual([fast, slow], list(as_completed([slow, fast])))
+        self.assertEqual(2, sleep_mock.call_count)
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    def test_wait_all_limits_concurrency(self, sleep_mock):
+        jobs = [make_job(1), make_job(0), make_job(0)]
+        submitted = []
+        submitter = lambda job: lambda: submitted.append(job) or job
+
+        finished = as_completed([submitter(job) for job in jobs], max_concurrent=2)
+        self.assertEqual(jobs[1], next(finished))
+        self.assertEqual(jobs[:2], submitted)
+        self.assertEqual([jobs[0], jobs[2]], list(finished))
+
+        jobs = [make_job(1), make_job(0)]
+        self.assertEqual(jobs, wait_all([submitter(job) for job in jobs], max_concurrent=1))
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    def test_wait_all_raises_job_error(self, sleep_mock):
+        failed = make_job(0, error_result={"reason": "invalidQuery"})
+        failed.exception.return_value = ValueError("invalid query")
+        with self.assertRaises(ValueError):
+            wait_all([make_job(0), failed])
+        self.assertEqual(2, len(wait_all([make_job(0), make_job(0, {"reason": "x"})],
+                                          raise_errors=False)))
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    @mock.patch("gcloud_utils.bigquery.jobs.time.time")
+    def test_as_completed_timeout(self, time_mock, sleep_mock):
+        time_mock.side_effect = [0, 5, 11]
+        with self.assertRaises(JobTimeout):
+            list(as_completed([make_job(10)], timeout=10))
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    def test_polls_with_reload(self, _):
+        job = make_job(1)
+        self.assertEqual([job], list(as_completed([job])))
+        self.assertEqual(2, job.reload.call_count)
+        job.done.assert_not_called()
+
+    @mock.patch("gcloud_utils.bigquery.jobs.time.sleep")
+    def test_finished_jobs_are_accounted_once(self, _):
+        ACCOUNTING.reset()
+        jobs = [make_job(1), make_job(0)]
+        for job in jobs:
+            job.total_bytes_billed = 10
+        wait_all(jobs + [lambda: FailedSubmission(IOError("quota"))], raise_errors=False)
+        self.assertEqual(2, ACCOUNTING.snapshot()["jobs"])
+        self.assertEqual(20, ACCOUNTING.snapshot()["total_bytes_billed"])
@@ -0,0 +1,82 @@
+"""Test metadata_cache Module"""
+import unittest
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from gcloud_utils.bigquery.bigquery import Bigquery
+from gcloud_utils.bigquery.metadata_cache import MetadataCache
+
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+
+class TestMetadataCache(unittest.TestCase):
+    "Test metadata_cache module"
+
+    def test_expires_after_ttl(self):
+        cache = MetadataCache(ttl=10)
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=100):
+            cache.set(("p", "d", "t"), True)
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=105):
+            self.assertTrue(cache.get(("p", "d", "t")))
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=111):
+            self.assertIsNone(cache.get(("p", "d", "t")))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_missing_entries_use_negative_ttl(self):
+        cache = MetadataCache(ttl=60)
+        cache.set(("p", "d", "t"), False)
+        self.assertIsNone(cache.get(("p", "d", "t")))
+
+        cache = MetadataCache(ttl=60, negative_ttl=10)
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=100):
+            cache.set(("p", "d", "t"), False)
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=105):
+            self.assertFalse(cache.get(("p", "d", "t")))
+        with mock.patch("gcloud_utils.bigquery.metadata_cache.time.time", return_value=111):
+            self.assertIsNone(cache.get(("p", "d", "t")))
+
+    def test_invalidate_drops_matching_entries_and_lists(self):
+        cache = MetadataCache(negative_ttl=60)
+        cache.set_tables("p", "d", [("t", True)])
+        cache.set(("p", "other"), True)
+
+        self.assertFalse(cache.get(("p", "d", "missing")))
+        cache.invalidate(dataset_id="d", table_id="missing")
+        self.assertIsNone(cache.get(("p", "d", "missing")))
+        self.assertTrue(cache.get(("p", "d", "t")))
+        cache.invalidate(project="p")
+        self.assertIsNone(cache.get(("p", "other")))
+
+    def test_creates_and_checks_are_cached(self):
+        client_mock = mock.Mock(project="p")
+        bq = Bigquery(client_mock, metadata_cache=MetadataCache())
+
+        bq.create_table("dataset", "table")
+        bq.create_table("dataset", "table")
+        bq.create_table("dataset", "other")
+        self.assertTrue(bq.table_exists("table", "dataset"))
+
+        client_mock.create_dataset.assert_called_once()
+        self.assertEqual(2, client_mock.create_table.call_count)
+        client_mock.get_table.assert_not_called()
+
+    def test_prefetch_tables(self):
+        client_mock = mock.Mock(project="p", **{
+            "list_tables.return_value": [mock.Mock(table_id="a"), mock.Mock(table_id="b")],
+            "get_table.side_effect": NotFound("missing")})
+        bq = Bigquery(client_mock, metadata_cache=MetadataCache(negative_ttl=60))
+
+        bq.prefetch_tables("dataset", project_id="other")
+
+        client_mock.dataset.assert_called_once_with("dataset", project="other")
+        bq.metadata_cache.invalidate()
+        bq.prefetch_tables("dataset")
+        self.assertTrue(bq.table_exists("a", "dataset"))
+        self.assertFalse(bq.table_exists("c", "dataset"))
+        self.assertIsInstance(bq.create_table("dataset", "b"), bigquery.Table)
+        self.assertIsInstance(bq.create_dataset("dataset"), bigquery.Dataset)
+        client_mock.get_table.assert_not_called()
+        client_mock.create_table.assert_not_called()
+        client_mock.create_dataset.assert_not_called()
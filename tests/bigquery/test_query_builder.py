@@ -1,7 +1,8 @@
 """Test QueryBuilder Module"""
 import unittest
 import os
-from gcloud_utils.bigquery.query_builder import QueryBuilder
+import tempfile
+from gcloud_utils.bigquery.query_builder import QueryBuilder, TemplateRegistry
 
 class TestQueryBuilder(unittest.TestCase):
     "Test QueryBuilder module"
@@ -36,3 +37,67 @@ class TestQueryBuilder(unittest.TestCase):
         expected = "select * from test where col = '20181011'"
         builder.with_vars(my_date="20181011")
         self.assertEqual(expected, builder.query)
+
+    def test_render_is_immutable(self):
+        builder = QueryBuilder("select * from ${table} where col = '${my_date}' and x = $$1")
+        first = builder.render(table="t", my_date="20181011")
+        second = builder.render(table="t", my_date="20181012")
+        self.assertEqual("select * from t where col = '20181011' and x = $1", first.query)
+        self.assertEqual("select * from t where col = '20181012' and x = $1", second.query)
+        self.assertEqual("select * from ${table} where col = '${my_date}' and x = $$1",
+                         builder.query)
+
+    def test_render_with_query_parameters(self):
+        builder = QueryBuilder("select * from ${table} where col = '${my_date}' and n > ${n}")
+        rendered = builder.render(params=("my_date", "n"), table="t", my_date="20181011", n=3)
+        self.assertEqual("select * from t where col = @my_date and n > @n", rendered.query)
+        self.assertEqual([("my_date", "STRING", "20181011"), ("n", "INT64", 3)],
+                         [(param.name, param.type_, param.value)
+                          for param in rendered.query_parameters])
+
+    def test_with_vars_sets_query_parameters(self):
+        builder = QueryBuilder("select * from t where col = '${my_date}'")
+        builder.with_vars(params=("my_date",), my_date="20181011")
+        self.assertEqual("select * from t where col = @my_date", builder.query)
+        self.assertEqual(["my_date"], [param.name for param in builder.query_parameters])
+
+    def test_registry_caches_files_by_mtime(self):
+        registry = TemplateRegistry()
+        path = os.path.join(tempfile.mkdtemp(), "query.sql")
+        with open(path, "w") as query_file:
+            query_file.write("select\n1")
+        self.assertEqual("select 1", QueryBuilder(path, registry).query)
+        self.assertEqual("select 1", QueryBuilder(path, registry).query)
+        self.assertEqual((1, 1), (registry.hits, registry.misses))
+
+        with open(path, "w") as query_file:
+            query_file.write("select 2")
+        os.utime(path, (0, 0))
+        self.assertEqual("select 2", QueryBuilder(path, registry).query)
+
+    def test_analyze_reports_unresolved_vars_and_tables(self):
+        builder = QueryBuilder(
+            "select 'from a.b' from `proj.data.${table}` t join ${dataset}.users u "
+            "on t.id = u.id join [legacy:data.events] /* from c.d */ where d = '${day}'")
+        rendered = builder.render(table="visits")
+
+        self.assertEqual({"unresolved": ["dataset", "day"],
+                          "tables": ["proj.data.visits", "legacy.data.events"]},
+                         rendered.analyze())
+        self.assertEqual(["table", "dataset", "day"], builder.unresolved)
+        self.assertEqual(["legacy.data.events"], builder.analyze()["tables"])
+
+    def test_analyze_skips_function_from(self):
+        builder = QueryBuilder(
+            "select extract(year from t.created_at), trim(both 'x' from t.name) "
+            "from proj.ds.events t")
+
+        self.assertEqual(["proj.ds.events"], builder.analyze()["tables"])
+
+    def test_analyze_reads_comma_separated_tables(self):
+        builder = QueryBuilder(
+            "select * from proj.ds.events t, proj.ds.other as a, t.items, "
+            "`proj.ds.third` where t.id = a.id")
+
+        self.assertEqual(["proj.ds.events", "proj.ds.other", "proj.ds.third"],
+                         builder.analyze()["tables"])
@@ -0,0 +1,110 @@
+"""Test result_cache Module"""
+import shutil
+import tempfile
+import unittest
+from gcloud_utils.bigquery.bigquery import Bigquery
+from gcloud_utils.bigquery.query_builder import QueryBuilder
+from gcloud_utils.bigquery.result_cache import (DiskBackend, MemoryBackend, QueryCache,
+                                                normalize_query)
+
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+
+class TestResultCache(unittest.TestCase):
+    "Test result_cache module"
+
+    def setUp(self):
+        self.modified = {"table": 1}
+        self.job_mock = mock.Mock(**{"result.return_value": iter([(1, "a"), (2, "b")]),
+                                     "referenced_tables": ["project.dataset.table"],
+                                     "statement_type": "SELECT"})
+        self.client_mock = mock.Mock(**{"query.return_value": self.job_mock,
+                                        "get_table.side_effect": self._get_table})
+
+    def _get_table(self, table):
+        return mock.Mock(modified=self.modified["table"])
+
+    def test_normalize_query(self):
+        self.assertEqual("select * from test where a = 1",
+                         normalize_query("\n select *\n  from test\twhere a = 1 ;\n"))
+
+    def test_normalize_query_keeps_literals(self):
+        self.assertEqual("select * from `my  table` where x = 'a  b'",
+                         normalize_query("select  *\nfrom `my  table` where x = 'a  b';"))
+        self.assertNotEqual(normalize_query("select 'a b'"), normalize_query("select 'a  b'"))
+
+    def test_statements_other_than_select_are_not_cached(self):
+        self.job_mock.statement_type = "DELETE"
+        bq = Bigquery(self.client_mock, query_cache=QueryCache())
+
+        bq.query("delete from test where true")
+        bq.query("delete from test where true")
+
+        self.assertEqual(2, self.client_mock.query.call_count)
+
+    def test_memory_backend_bounded_by_rows(self):
+        backend = MemoryBackend(max_rows=3)
+        backend.set("a", {"rows": [1, 2]})
+        backend.set("b", {"rows": [3]})
+        backend.set("c", {"rows": [4, 5]})
+        backend.set("huge", {"rows": [1, 2, 3, 4]})
+
+        self.assertIsNone(backend.get("a"))
+        self.assertEqual({"rows": [3]}, backend.get("b"))
+        self.assertEqual({"rows": [4, 5]}, backend.get("c"))
+        self.assertIsNone(backend.get("huge"))
+
+    def test_query_served_from_cache(self):
+        bq = Bigquery(self.client_mock, query_cache=QueryCache())
+
+        first = bq.query(QueryBuilder("select * from test"))
+        second = bq.query("select *   from test;")
+
+        self.assertEqual([(1, "a"), (2, "b")], first)
+        self.assertEqual(first, second)
+        self.client_mock.query.assert_called_once_with(query="select * from test")
+
+    def test_cache_invalidated_by_table_change_and_ttl(self):
+        cache = QueryCache(ttl=60)
+        bq = Bigquery(self.client_mock, query_cache=cache)
+        bq.query("select * from test")
+
+        self.modified["table"] = 2
+        self.job_mock.result.return_value = iter([(3, "c")])
+        self.assertEqual([(3, "c")], bq.query("select * from test"))
+        self.assertEqual(2, self.client_mock.query.call_count)
+
+        with mock.patch("gcloud_utils.bigquery.result_cache.time.time",
+                        return_value=10 ** 12):
+            self.job_mock.result.return_value = iter([])
+            self.assertEqual([], bq.query("select * from test"))
+        self.assertEqual(3, self.client_mock.query.call_count)
+        self.assertEqual(0, cache.hits)
+
+    def test_queries_to_table_are_not_cached(self):
+        bq = Bigquery(self.client_mock, query_cache=QueryCache())
+        bq.query_to_table("select * from test", "dataset", "table")
+        bq.query_to_table("select * from test", "dataset", "table")
+        self.assertEqual(2, self.client_mock.query.call_count)
+
+    def test_memory_backend_eviction(self):
+        backend = MemoryBackend(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+        self.assertEqual(1, backend.get("a"))
+        self.assertIsNone(backend.get("b"))
+
+    def test_disk_backend(self):
+        directory = tempfile.mkdtemp()
+        backend = DiskBackend(directory, max_bytes=10 ** 6)
+        backend.set("key", {"rows": [(1, "a")]})
+        self.assertEqual({"rows": [(1, "a")]}, DiskBackend(directory).get("key"))
+        backend.max_bytes = 0
+        backend.set("other", {"rows": []})
+        self.assertIsNone(backend.get("key"))
+        shutil.rmtree(directory)
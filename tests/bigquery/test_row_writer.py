@@ -0,0 +1,140 @@
+"""Test row_writer Module"""
+import unittest
+from google.cloud import bigquery
+from gcloud_utils.bigquery.bigquery import Bigquery
+from gcloud_utils.bigquery.row_writer import RowWriter
+
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+SCHEMA = [bigquery.SchemaField("name", "STRING"), bigquery.SchemaField("age", "INTEGER")]
+
+
+class TestRowWriter(unittest.TestCase):
+    "Test row_writer module"
+
+    def test_flushes_by_row_count(self):
+        client_mock = mock.Mock(**{"insert_rows.return_value": []})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA, max_rows=2)
+
+        writer.write_many([{"name": "a", "age": 1}, ("b", 2), ("c", 3)])
+        self.assertEqual(1, client_mock.insert_rows.call_count)
+        args, kwargs = client_mock.insert_rows.call_args
+        self.assertEqual(("table", [{"name": "a", "age": 1}, {"name": "b", "age": 2}]), args)
+        self.assertEqual(SCHEMA, kwargs["selected_fields"])
+
+        writer.close()
+        self.assertEqual(2, client_mock.insert_rows.call_count)
+        self.assertEqual(3, writer.stats["rows_written"])
+        self.assertEqual(2, writer.stats["flushes"])
+
+    def test_flushes_by_bytes_and_fetches_schema(self):
+        client_mock = mock.Mock(**{"insert_rows.return_value": [],
+                                   "get_table.return_value.schema": SCHEMA})
+        writer = RowWriter(client_mock, "table", max_bytes=10)
+
+        writer.write(("a long enough name", 1))
+        client_mock.get_table.assert_called_once_with("table")
+        client_mock.insert_rows.assert_called_once()
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_retries_only_stopped_rows(self, sleep_mock):
+        invalid = [{"reason": "invalid", "message": "no such field"}]
+        stopped = [{"reason": "stopped", "message": ""}]
+        client_mock = mock.Mock(**{"insert_rows.side_effect": [
+            [{"index": 0, "errors": stopped}, {"index": 1, "errors": invalid},
+             {"index": 2, "errors": stopped}], []]})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA, retries=3)
+
+        with writer:
+            writer.write_many([("a", 1), ("b", 2), ("c", 3)])
+
+        first, retry = client_mock.insert_rows.call_args_list
+        self.assertEqual([{"name": "a", "age": 1}, {"name": "c", "age": 3}], retry[0][1])
+        self.assertEqual([first[1]["row_ids"][0], first[1]["row_ids"][2]], retry[1]["row_ids"])
+        self.assertEqual([({"name": "b", "age": 2}, invalid)], writer.failed_rows)
+        self.assertEqual(2, writer.stats["rows_written"])
+        self.assertEqual(1, writer.stats["rows_failed"])
+        sleep_mock.assert_called_once()
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_invalid_rows_alone_are_not_retried(self, sleep_mock):
+        invalid = [{"reason": "invalid", "message": "no such field"}]
+        client_mock = mock.Mock(**{"insert_rows.return_value": [{"index": 0, "errors": invalid}]})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA)
+
+        writer.write(("a", 1))
+        writer.flush()
+
+        client_mock.insert_rows.assert_called_once()
+        sleep_mock.assert_not_called()
+        self.assertEqual(1, writer.stats["rows_failed"])
+
+    def test_load_method_sends_json_lines(self):
+        client_mock = mock.Mock()
+        bq = Bigquery(client_mock)
+        writer = bq.row_writer("dataset", "table", schema=SCHEMA, method="load")
+
+        writer.write_many([("a", 1), ("b", 2)])
+        writer.flush()
+
+        args, kwargs = client_mock.load_table_from_file.call_args
+        lines = args[0].getvalue().decode("utf-8").split("\n")
+        self.assertEqual(['{"name": "a", "age": 1}', '{"name": "b", "age": 2}'], lines)
+        self.assertEqual(client_mock.dataset.return_value.table.return_value, args[1])
+        self.assertEqual("NEWLINE_DELIMITED_JSON", kwargs["job_config"].source_format)
+        self.assertEqual(2, writer.stats["rows_written"])
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_insert_errors_keep_rows_as_failed(self, sleep_mock):
+        client_mock = mock.Mock(**{"insert_rows.side_effect": IOError("request too large")})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA, retries=2)
+
+        writer.write_many([("a", 1), ("b", 2)])
+        self.assertEqual(0, writer.flush())
+
+        self.assertEqual(3, client_mock.insert_rows.call_count)
+        self.assertEqual(2, sleep_mock.call_count)
+        self.assertEqual([({"name": "a", "age": 1}, ["request too large"]),
+                          ({"name": "b", "age": 2}, ["request too large"])], writer.failed_rows)
+        self.assertEqual(0, writer.stats["rows_written"])
+        self.assertEqual(2, writer.stats["rows_failed"])
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_insert_error_is_retried(self, sleep_mock):
+        client_mock = mock.Mock(**{"insert_rows.side_effect": [IOError("backend error"), []]})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA)
+
+        writer.write(("a", 1))
+        self.assertEqual(1, writer.flush())
+
+        first, retry = client_mock.insert_rows.call_args_list
+        self.assertEqual(first[1]["row_ids"], retry[1]["row_ids"])
+        self.assertEqual([], writer.failed_rows)
+        sleep_mock.assert_called_once()
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_load_errors_keep_rows_as_failed(self, sleep_mock):
+        client_mock = mock.Mock(**{"load_table_from_file.side_effect": IOError("backend error")})
+        writer = RowWriter(client_mock, "table", schema=SCHEMA, method="load", retries=1)
+
+        writer.write(("a", 1))
+        self.assertEqual(0, writer.flush())
+
+        self.assertEqual(2, client_mock.load_table_from_file.call_count)
+        sleep_mock.assert_called_once()
+        self.assertEqual([({"name": "a", "age": 1}, ["backend error"])], writer.failed_rows)
+
+    @mock.patch("gcloud_utils.bigquery.row_writer.time.sleep")
+    def test_schema_errors_keep_rows_as_failed(self, sleep_mock):
+        client_mock = mock.Mock(**{"get_table.side_effect": IOError("not found")})
+        writer = RowWriter(client_mock, "table", method="load", retries=0)
+
+        writer.write({"name": "a", "age": 1})
+        writer.flush()
+
+        client_mock.load_table_from_file.assert_not_called()
+        sleep_mock.assert_not_called()
+        self.assertEqual([({"name": "a", "age": 1}, ["not found"])], writer.failed_rows)
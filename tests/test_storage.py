@@ -1,8 +1,15 @@
 """Test Storage Module"""
 import unittest
+import io
 import os
+import gzip
+import base64
+import hashlib
+import shutil
+import tempfile
 from google.cloud import storage
-from gcloud_utils.storage import Storage
+from gcloud_utils.storage import Storage, TransferError
+from gcloud_utils.blob_cache import BlobCache
 
 try:
     import mock
@@ -48,15 +55,550 @@ class TestStorage(unittest.TestCase):
         bucket_name = "teste_bucket"
         bucket_mock = mock.Mock(**{"list_blobs.return_value": [blob_mock1, blob_mock2, blob_mock3]})
 
-        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock,
+                                   "batch.return_value": mock.MagicMock()})
 
         storage_test = Storage(bucket_name, client_mock)
-        storage_test.rename_files("ttt", "l")
+        result = storage_test.rename_files("ttt", "l")
 
         bucket_mock.list_blobs.assert_called_once_with(prefix="ttt")
 
-        bucket_mock.rename_blob.assert_has_calls([
-            mock.call(blob_mock1, expected_full_name1),
-            mock.call(blob_mock2, expected_full_name2),
-            mock.call(blob_mock3, expected_full_name3)
-        ])
\ No newline at end of file
+        bucket_mock.copy_blob.assert_has_calls([
+            mock.call(blob_mock1, bucket_mock, expected_full_name1),
+            mock.call(blob_mock2, bucket_mock, expected_full_name2),
+            mock.call(blob_mock3, bucket_mock, expected_full_name3)
+        ])
+        for blob_mock in (blob_mock1, blob_mock2, blob_mock3):
+            blob_mock.delete.assert_called_once_with()
+        self.assertEqual(2, client_mock.batch.call_count)
+        self.assertEqual(["ttt_est1", "ttt_est2", "ttt_est3"], result["succeeded"])
+        self.assertEqual({}, result["failed"])
+
+
+    def test_download_files_parallel(self):
+        def make_blob(name, size):
+            blob = mock.Mock(size=size)
+            blob.name = name
+            blob.download_to_file.side_effect = lambda f: f.write(b"x" * size)
+            return blob
+
+        blobs = [make_blob("path/file_{}".format(i), 10) for i in range(5)]
+        blobs[2].download_to_file.side_effect = IOError("boom")
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": blobs})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        progress = mock.Mock()
+        local_path = tempfile.mkdtemp()
+
+        storage_test = Storage("teste_bucket", client_mock)
+        summary = storage_test.download_files("path", local_path, workers=3,
+                                              max_bytes=40, progress=progress)
+
+        self.assertEqual(["path/file_4"], summary.skipped)
+        self.assertEqual(["path/file_2"], list(summary.failed))
+        self.assertEqual(sorted(["path/file_0", "path/file_1", "path/file_3"]),
+                         sorted(summary.transferred))
+        self.assertEqual(30, summary.bytes)
+        self.assertEqual(4, progress.call_count)
+        self.assertTrue(os.path.exists(os.path.join(local_path, "path/file_0")))
+        bucket_mock.get_blob.assert_not_called()
+        shutil.rmtree(local_path)
+
+    def test_upload_path_parallel(self):
+        local_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(local_path, "a"))
+        os.makedirs(os.path.join(local_path, "b"))
+        for directory in ("a", "b"):
+            with open(os.path.join(local_path, directory, "part.txt"), "w") as part:
+                part.write("content")
+        bucket_mock = mock.Mock()
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        summary = storage_test.upload_path("dest", local_path, workers=2, preserve_structure=True)
+        self.assertEqual(["dest/a/part.txt", "dest/b/part.txt"], sorted(summary.transferred))
+        self.assertEqual(14, summary.bytes)
+        self.assertEqual(set(summary.transferred), set(summary.timings))
+
+        summary = storage_test.upload_path("dest", local_path, workers=2)
+        self.assertEqual(["dest/part.txt"], summary.transferred)
+        self.assertEqual(1, len(summary.skipped))
+        shutil.rmtree(local_path)
+
+    def test_sync_dry_run_upload(self):
+        local_path = tempfile.mkdtemp()
+        for name, content in (("same.txt", b"same"), ("changed.txt", b"new"), ("new.txt", b"n")):
+            with open(os.path.join(local_path, name), "wb") as local_file:
+                local_file.write(content)
+
+        def make_blob(name, content):
+            blob = mock.Mock(size=len(content), crc32c=None,
+                             md5_hash=base64.b64encode(hashlib.md5(content).digest()).decode())
+            blob.name = name
+            return blob
+
+        blobs = [make_blob("dest/same.txt", b"same"), make_blob("dest/changed.txt", b"old"),
+                 make_blob("dest/extra.txt", b"extra")]
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": blobs})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        plan = storage_test.sync(local_path, "dest", delete=True, dry_run=True)
+
+        bucket_mock.list_blobs.assert_called_once_with(prefix="dest/")
+        self.assertEqual(["changed.txt", "new.txt"], plan["transfer"])
+        self.assertEqual(["extra.txt"], plan["delete"])
+        self.assertEqual(["same.txt"], plan["unchanged"])
+        bucket_mock.blob.assert_not_called()
+
+        plan = storage_test.sync(local_path, "dest", delete=True, workers=2)
+        self.assertEqual(["changed.txt", "new.txt"], sorted(plan["summary"].transferred))
+        blobs[2].delete.assert_called_once_with()
+        shutil.rmtree(local_path)
+
+    def test_open_streams_gzip_lines(self):
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as gzip_file:
+            for i in range(1000):
+                gzip_file.write('{{"line": {}}}\n'.format(i).encode())
+        content = compressed.getvalue()
+        blob_mock = mock.Mock(size=len(content))
+        blob_mock.name = "export/file_000.json.gz"
+        blob_mock.download_as_string.side_effect = lambda start, end: content[start:end + 1]
+        bucket_mock = mock.Mock(**{"get_blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        records = storage_test.iter_records("export/file_000.json.gz", chunk_size=64)
+        self.assertEqual({"line": 0}, next(records))
+        self.assertEqual(list(range(1, 1000)), [record["line"] for record in records])
+        self.assertTrue(blob_mock.download_as_string.call_count > 1)
+        for call_args in blob_mock.download_as_string.call_args_list:
+            self.assertTrue(call_args[1]["end"] - call_args[1]["start"] < 64)
+
+    def test_download_file_sliced(self):
+        content = os.urandom(1000)
+
+        def download_range(local_file, start, end):
+            local_file.write(content[start:end + 1])
+
+        blob_mock = mock.Mock(size=len(content), crc32c=None,
+                              md5_hash=base64.b64encode(hashlib.md5(content).digest()).decode())
+        blob_mock.name = "model/checkpoint.bin"
+        blob_mock.download_to_file.side_effect = download_range
+        bucket_mock = mock.Mock(**{"get_blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        storage_test = Storage("teste_bucket", client_mock)
+
+        full_path = storage_test.download_file("model/checkpoint.bin", local_path,
+                                               slice_threshold=500, slice_size=300, workers=4)
+
+        self.assertEqual(4, blob_mock.download_to_file.call_count)
+        with open(full_path, "rb") as local_file:
+            self.assertEqual(content, local_file.read())
+
+        blob_mock.md5_hash = "wrong"
+        with self.assertRaises(IOError):
+            storage_test.download_file("model/checkpoint.bin", local_path,
+                                       slice_threshold=500, slice_size=300)
+        self.assertFalse(os.path.exists(full_path))
+        shutil.rmtree(local_path)
+
+    def test_upload_file_composite(self):
+        local_path = tempfile.mkdtemp()
+        file_path = os.path.join(local_path, "artifact.bin")
+        with open(file_path, "wb") as local_file:
+            local_file.write(os.urandom(1000))
+        uploaded = {}
+        blobs = {}
+
+        def make_blob(name):
+            if name not in blobs:
+                blob = mock.Mock()
+                blob.name = name
+                blob.upload_from_file.side_effect = \
+                    lambda loc, size=None: uploaded.__setitem__(name, loc.read(size))
+                blobs[name] = blob
+            return blobs[name]
+
+        bucket_mock = mock.Mock(**{"blob.side_effect": make_blob})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        storage_test.upload_file("dest/artifact.bin", file_path,
+                                 composite_threshold=500, part_size=30, workers=4)
+
+        parts = sorted(name for name in uploaded)
+        self.assertEqual(34, len(parts))
+        with open(file_path, "rb") as local_file:
+            self.assertEqual(local_file.read(), b"".join(uploaded[name] for name in parts))
+        final_sources = blobs["dest/artifact.bin"].compose.call_args[0][0]
+        self.assertEqual(2, len(final_sources))
+        for name in parts:
+            blobs[name].delete.assert_called_once_with()
+        for intermediate in final_sources:
+            intermediate.delete.assert_called_once_with()
+        shutil.rmtree(local_path)
+
+    def test_upload_file_composite_cleans_parts_on_failure(self):
+        local_path = tempfile.mkdtemp()
+        file_path = os.path.join(local_path, "artifact.bin")
+        with open(file_path, "wb") as local_file:
+            local_file.write(os.urandom(100))
+        part_blob = mock.Mock()
+        part_blob.name = "part"
+        final_blob = mock.Mock(**{"compose.side_effect": IOError("compose failed")})
+        bucket_mock = mock.Mock(**{"blob.side_effect":
+                                   lambda name: final_blob if name == "dest" else part_blob})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        with self.assertRaises(IOError):
+            storage_test.upload_file("dest", file_path, composite_threshold=10, part_size=50)
+        self.assertEqual(2, part_blob.delete.call_count)
+        shutil.rmtree(local_path)
+
+    def test_delete_path_batched(self):
+        blobs = []
+        for i in range(250):
+            blob = mock.Mock()
+            blob.name = "tmp/file_{}".format(i)
+            blobs.append(blob)
+        blobs[120].delete.side_effect = [None, IOError("forbidden")]
+        failing_batch = mock.MagicMock()
+        failing_batch.__exit__.side_effect = IOError("batch failed")
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": blobs})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        client_mock.batch.side_effect = [mock.MagicMock(), failing_batch, mock.MagicMock()]
+
+        storage_test = Storage("teste_bucket", client_mock)
+        result = storage_test.delete_path("tmp")
+
+        self.assertEqual(3, client_mock.batch.call_count)
+        self.assertEqual(["tmp/file_120"], list(result["failed"]))
+        self.assertEqual(249, len(result["succeeded"]))
+        self.assertEqual(2, blobs[150].delete.call_count)
+        blobs[0].delete.assert_called_once_with()
+
+    def test_ls_uses_delimiter_listing(self):
+        def make_page(names, prefixes):
+            blobs = []
+            for name in names:
+                blob = mock.Mock()
+                blob.name = name
+                blobs.append(blob)
+            page = mock.MagicMock(prefixes=prefixes)
+            page.__iter__.return_value = iter(blobs)
+            return page
+
+        iterators = [
+            mock.Mock(pages=iter([make_page(["data/", "data/b.txt"], ("data/dir1/",))]),
+                      next_page_token="token"),
+            mock.Mock(pages=iter([make_page(["data/a.txt"], ("data/dir1/", "data/dir0/"))]),
+                      next_page_token=None)]
+        bucket_mock = mock.Mock(**{"list_blobs.side_effect": iterators})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        items = storage_test.iter_ls("data", page_size=2)
+        self.assertEqual(["b.txt", "dir1"], [next(items), next(items)])
+        bucket_mock.list_blobs.assert_called_once_with(
+            prefix="data/", delimiter="/", max_results=2, page_token=None)
+        self.assertEqual(["a.txt", "dir0"], list(items))
+        bucket_mock.list_blobs.assert_called_with(
+            prefix="data/", delimiter="/", max_results=2, page_token="token")
+
+    def test_ls(self):
+        blob_mock = mock.Mock()
+        blob_mock.name = "data/b.txt"
+        page = mock.MagicMock(prefixes=("data/dir/",))
+        page.__iter__.return_value = iter([blob_mock])
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": mock.Mock(pages=iter([page]))})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        self.assertEqual(["b.txt", "dir"], storage_test.ls("data/"))
+        bucket_mock.list_blobs.assert_called_once_with(prefix="data/", delimiter="/")
+
+    def test_iter_files_filters_while_streaming(self):
+        def make_blob(name, size):
+            blob = mock.Mock(size=size)
+            blob.name = name
+            return blob
+
+        blobs = [make_blob("exports/2018/", 0), make_blob("exports/2018/a.csv", 10),
+                 make_blob("exports/2018/b.json", 10), make_blob("exports/2018/c.csv", 1),
+                 make_blob("exports/2018/d.csv", 20)]
+        consumed = []
+
+        def list_blobs(**kwargs):
+            for blob in blobs:
+                consumed.append(blob.name)
+                yield blob
+
+        bucket_mock = mock.Mock(**{"list_blobs.side_effect": list_blobs})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        files = storage_test.iter_files("exports", pattern="exports/2018/*.csv",
+                                        min_size=5, fields="md5Hash", max_results=1)
+
+        self.assertEqual(["exports/2018/a.csv"], [blob.name for blob in files])
+        self.assertEqual(2, len(consumed))
+        bucket_mock.list_blobs.assert_called_once_with(
+            prefix="exports/2018/", fields="items(md5Hash,name,size),nextPageToken")
+        self.assertEqual(["exports/2018/a.csv", "exports/2018/d.csv"],
+                         [blob.name for blob in storage_test.list_files("exports", ".csv", min_size=5)])
+
+    def test_download_file_with_cache(self):
+        blob_mock = mock.Mock(generation=1)
+        blob_mock.name = "ref/dictionary.txt"
+        blob_mock.download_to_file.side_effect = lambda f: f.write(b"v1")
+        bucket_mock = mock.Mock(**{"get_blob.return_value": blob_mock})
+        bucket_mock.name = "teste_bucket"
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        cache = BlobCache(os.path.join(local_path, "cache"), max_bytes=3)
+        storage_test = Storage("teste_bucket", client_mock, cache=cache)
+
+        storage_test.download_file("ref/dictionary.txt", local_path)
+        full_path = storage_test.get_file("ref/dictionary.txt", local_path)
+        self.assertEqual("v1", full_path.read())
+        full_path.close()
+        self.assertEqual(1, blob_mock.download_to_file.call_count)
+        self.assertEqual({"hits": 1, "misses": 1, "evictions": 0}, cache.stats)
+
+        blob_mock.generation = 2
+        blob_mock.download_to_file.side_effect = lambda f: f.write(b"v2")
+        storage_test.download_file("ref/dictionary.txt", local_path)
+        self.assertEqual(2, blob_mock.download_to_file.call_count)
+
+        other_blob = mock.Mock(generation=1)
+        other_blob.download_to_file.side_effect = lambda f: f.write(b"other")
+        bucket_mock.get_blob.return_value = other_blob
+        storage_test.download_file("ref/other.txt", local_path)
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(5, cache.size())
+
+        cache.revalidate = False
+        bucket_mock.get_blob.reset_mock()
+        storage_test.download_file("ref/other.txt", local_path)
+        bucket_mock.get_blob.assert_not_called()
+        shutil.rmtree(local_path)
+
+    def test_cache_survives_eviction_and_serves_many_files(self):
+        blob_mock = mock.Mock(generation=1, size=2)
+        blob_mock.name = "ref/dictionary.txt"
+        blob_mock.download_to_file.side_effect = lambda f: f.write(b"v1")
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": [blob_mock]})
+        bucket_mock.name = "teste_bucket"
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        cache = BlobCache(os.path.join(local_path, "cache"))
+        storage_test = Storage("teste_bucket", client_mock, cache=cache)
+
+        summary = storage_test.download_files("ref/", os.path.join(local_path, "a"), workers=2)
+        self.assertEqual(["ref/dictionary.txt"], summary.transferred)
+        bucket_mock.get_blob.assert_not_called()
+
+        evicted = os.path.join(local_path, "evicted")
+        with mock.patch.object(cache, "path_for", side_effect=[evicted, None]):
+            summary = storage_test.download_files("ref/", os.path.join(local_path, "b"), workers=2)
+        self.assertEqual({}, summary.failed)
+        with open(os.path.join(local_path, "b", "ref", "dictionary.txt")) as local_file:
+            self.assertEqual("v1", local_file.read())
+        self.assertEqual(2, blob_mock.download_to_file.call_count)
+        shutil.rmtree(local_path)
+
+    def test_get_files_in_path_reports_failed_files(self):
+        blobs = []
+        for name in ("data/ok", "data/broken"):
+            blob = mock.Mock(size=1)
+            blob.name = name
+            blobs.append(blob)
+        blobs[0].download_to_file.side_effect = lambda f: f.write(b"x")
+        blobs[1].download_to_file.side_effect = IOError("connection reset")
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": blobs})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        storage_test = Storage("teste_bucket", client_mock)
+
+        with self.assertRaises(TransferError) as context:
+            storage_test.get_files_in_path("data/", local_path, workers=2)
+        self.assertEqual(["data/broken"], list(context.exception.failed))
+        self.assertIsInstance(context.exception, IOError)
+        shutil.rmtree(local_path)
+
+    def test_open_mmap_downloads_once(self):
+        content = b"0123456789"
+        blob_mock = mock.Mock(size=len(content), crc32c=None, generation=7,
+                              md5_hash=base64.b64encode(hashlib.md5(content).digest()).decode())
+        blob_mock.name = "index/vectors.bin"
+        blob_mock.download_to_file.side_effect = lambda f: f.write(content)
+        bucket_mock = mock.Mock(**{"get_blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        storage_test = Storage("teste_bucket", client_mock)
+
+        memory_map = storage_test.open_mmap("index/vectors.bin", local_path)
+        self.assertEqual(content, memory_map[:])
+        with self.assertRaises(TypeError):
+            memory_map[0] = b"x"
+        memory_map.close()
+
+        memory_map = storage_test.open_mmap("index/vectors.bin", local_path)
+        self.assertEqual(b"2345", memory_map[2:6])
+        memory_map.close()
+        self.assertEqual(1, blob_mock.download_to_file.call_count)
+        self.assertEqual(["vectors.bin", "vectors.bin.generation"],
+                         sorted(os.listdir(os.path.join(local_path, "index"))))
+
+        with mock.patch("gcloud_utils.storage._file_md5") as md5_mock:
+            storage_test.open_mmap("index/vectors.bin", local_path).close()
+        md5_mock.assert_not_called()
+        blob_mock.generation = 8
+        storage_test.open_mmap("index/vectors.bin", local_path).close()
+        self.assertEqual(2, blob_mock.download_to_file.call_count)
+        shutil.rmtree(local_path)
+
+    def test_open_mmap_empty_file(self):
+        blob_mock = mock.Mock(size=0, generation=1)
+        blob_mock.name = "empty.bin"
+        bucket_mock = mock.Mock(**{"get_blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        local_path = tempfile.mkdtemp()
+        storage_test = Storage("teste_bucket", client_mock)
+
+        self.assertEqual(b"", storage_test.open_mmap("empty.bin", local_path))
+        self.assertEqual(0, len(storage_test.open_mmap("empty.bin", local_path, dtype="float32")))
+        shutil.rmtree(local_path)
+
+    def test_upload_stream_resumable_gzip(self):
+        uploaded = []
+
+        def resumable_upload(stream, content_type=None):
+            self.assertEqual(0, stream.tell())
+            while True:
+                start = stream.tell()
+                payload = stream.read(blob_mock.chunk_size)
+                if start == 0:
+                    stream.seek(0)
+                    self.assertEqual(payload, stream.read(blob_mock.chunk_size))
+                uploaded.append(payload)
+                if len(payload) < blob_mock.chunk_size:
+                    return
+
+        blob_mock = mock.Mock(**{"upload_from_file.side_effect": resumable_upload})
+        bucket_mock = mock.Mock(**{"blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+        lines = ["line {} {}\n".format(i, i * 7919 % 104729) for i in range(100000)]
+
+        storage_test.upload_stream("out/data.txt.gz", iter(lines), compress=True,
+                                   chunk_size=256 * 1024)
+
+        self.assertEqual(256 * 1024, blob_mock.chunk_size)
+        self.assertTrue(len(uploaded) > 1)
+        self.assertEqual("".join(lines).encode(),
+                         gzip.GzipFile(fileobj=io.BytesIO(b"".join(uploaded))).read())
+
+    def test_open_writer_aborts_on_error(self):
+        errors = []
+
+        def resumable_upload(stream, content_type=None):
+            try:
+                stream.read(blob_mock.chunk_size)
+            except IOError as error:
+                errors.append(error)
+                raise
+
+        blob_mock = mock.Mock(**{"upload_from_file.side_effect": resumable_upload})
+        bucket_mock = mock.Mock(**{"blob.return_value": blob_mock})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        with self.assertRaises(ValueError):
+            with storage_test.open_writer("out/data.txt") as writer:
+                writer.write("partial")
+                raise ValueError("producer failed")
+        self.assertEqual(1, len(errors))
+
+    def test_copy_file_cross_bucket_with_rewrite_tokens(self):
+        destination_blob = mock.Mock(**{"rewrite.side_effect": [
+            ("token1", 10, 30), ("token2", 20, 30), (None, 30, 30)]})
+        destination_bucket = mock.Mock(**{"blob.return_value": destination_blob})
+        bucket_mock = mock.Mock()
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock,
+                                   "bucket.return_value": destination_bucket})
+        progress = mock.Mock()
+        storage_test = Storage("teste_bucket", client_mock)
+
+        self.assertEqual(30, storage_test.copy_file("a/file", "b/file", "other_bucket", progress))
+
+        client_mock.bucket.assert_called_once_with("other_bucket")
+        destination_bucket.blob.assert_called_once_with("b/file")
+        destination_blob.rewrite.assert_has_calls([
+            mock.call(bucket_mock.blob.return_value),
+            mock.call(bucket_mock.blob.return_value, token="token1"),
+            mock.call(bucket_mock.blob.return_value, token="token2")])
+        progress.assert_has_calls([mock.call(10, 30), mock.call(20, 30), mock.call(30, 30)])
+
+    def test_copy_path(self):
+        blobs = []
+        for i in range(3):
+            blob = mock.Mock()
+            blob.name = "src/part_{}".format(i)
+            blobs.append(blob)
+        destination_blobs = {}
+
+        def make_destination(name):
+            destination_blobs[name] = mock.Mock(**{"rewrite.return_value": (None, 5, 5)})
+            return destination_blobs[name]
+
+        bucket_mock = mock.Mock(**{"list_blobs.return_value": blobs,
+                                   "blob.side_effect": make_destination})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        summary = storage_test.copy_path("src/", "dst/", workers=2)
+
+        self.assertEqual(["dst/part_0", "dst/part_1", "dst/part_2"], sorted(destination_blobs))
+        self.assertEqual(15, summary.bytes)
+        destination_blobs["dst/part_1"].rewrite.assert_called_once_with(blobs[1])
+
+    def test_exists_many(self):
+        existing = {}
+        for name in ("dt=20181010/_SUCCESS", "dt=20181011/_SUCCESS"):
+            existing[name] = mock.Mock()
+            existing[name].name = name
+        paths = ["dt=20181010/_SUCCESS", "dt=20181011/_SUCCESS", "dt=20181012/_SUCCESS"]
+        expected = {"dt=20181010/_SUCCESS": True, "dt=20181011/_SUCCESS": True,
+                    "dt=20181012/_SUCCESS": False}
+        bucket_mock = mock.Mock(**{"get_blob.side_effect": existing.get,
+                                   "list_blobs.return_value": list(existing.values())})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        self.assertEqual(expected, storage_test.exists_many(paths, workers=3))
+        self.assertEqual(3, bucket_mock.get_blob.call_count)
+        bucket_mock.list_blobs.assert_not_called()
+
+        stats = storage_test.stat_many(paths, from_listing=True)
+        self.assertEqual(existing["dt=20181011/_SUCCESS"], stats["dt=20181011/_SUCCESS"])
+        self.assertIsNone(stats["dt=20181012/_SUCCESS"])
+        bucket_mock.list_blobs.assert_called_once_with(prefix="dt=2018101")
+        self.assertEqual(3, bucket_mock.get_blob.call_count)
+
+        self.assertEqual({}, storage_test.stat_many([], from_listing=True))
+        bucket_mock.list_blobs.assert_called_once()
+
+    def test_exists_many_agree_on_placeholders(self):
+        placeholder = mock.Mock()
+        placeholder.name = "dir/"
+        bucket_mock = mock.Mock(**{"get_blob.return_value": placeholder,
+                                   "list_blobs.return_value": [placeholder]})
+        client_mock = mock.Mock(**{"get_bucket.return_value": bucket_mock})
+        storage_test = Storage("teste_bucket", client_mock)
+
+        self.assertEqual({"dir/": True}, storage_test.exists_many(["dir/"]))
+        self.assertEqual({"dir/": True}, storage_test.exists_many(["dir/"], from_listing=True))